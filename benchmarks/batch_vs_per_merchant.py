@@ -0,0 +1,50 @@
+"""
+    Compares the per merchant disbursement -one /calculate_disbursement job per merchant- against the batch engine
+    on the seed data.
+
+    Usage: python -m benchmarks.batch_vs_per_merchant --year 2018 --week 2
+"""
+import argparse
+import time
+
+from sequra import app as flask_app
+from sequra.batch import disburse_week
+from sequra.database.models import Disbursement, Merchant
+from sequra.jobs import job_queue
+
+
+def per_merchant(client, year, week, merchants):
+    for merchant in merchants:
+        client.get('/calculate_disbursement', query_string={'year': year, 'week': week, 'merchant_name': merchant.name})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--year', type=int, default=2018)
+    parser.add_argument('--week', type=int, default=2)
+    args = parser.parse_args()
+
+    flask_app.initialize_app(flask_app.app)
+    flask_app.initialize_db()
+    with flask_app.app.app_context():
+        merchants = Merchant.query.all()
+
+        start = time.perf_counter()
+        with flask_app.app.test_client() as client:
+            per_merchant(client, args.year, args.week, merchants)
+        job_queue.wait()
+        per_merchant_time = time.perf_counter() - start
+        expected = {dis.merchant_id: dis.amount for dis in Disbursement.query.filter_by(year=args.year, week=args.week)}
+
+        start = time.perf_counter()
+        amounts = disburse_week(year=args.year, week=args.week)
+        batch_time = time.perf_counter() - start
+
+    assert amounts == expected, 'Batch and per merchant disbursements differ'
+    print(f'merchants: {len(merchants)}')
+    print(f'per merchant: {per_merchant_time:.4f}s')
+    print(f'batch: {batch_time:.4f}s ({per_merchant_time / batch_time:.1f}x)')
+
+
+if __name__ == "__main__":
+    main()
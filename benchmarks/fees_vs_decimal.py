@@ -0,0 +1,80 @@
+"""
+    Checks the integer cents fee engine against a per order Decimal loop on the full seed dataset,
+    every (merchant, ISO week) total must be equal.
+
+    The loop used before the cents engine built its rates from binary floats -decimal.Decimal(0.0095)-,
+    its totals are reported apart since they differ whenever an order fee ends exactly in half a cent.
+
+    Usage: python -m benchmarks.fees_vs_decimal
+"""
+import datetime
+import decimal
+import json
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from sequra import fees
+
+ORDERS_FILE = Path(__file__).parent.parent / 'sequra' / 'resources' / 'orders.json'
+
+
+def decimal_loop(amounts, rates):
+    disbursed_amount = decimal.Decimal('0.00')
+    for amount in amounts:
+        if amount < 50:
+            disbursed_amount = disbursed_amount + amount + (amount * rates[0])
+        elif 50 <= amount < 300:
+            disbursed_amount = disbursed_amount + amount + (amount * rates[1])
+        else:
+            disbursed_amount = disbursed_amount + amount + (amount * rates[2])
+    return disbursed_amount.quantize(fees.CENTS, rounding=decimal.ROUND_HALF_UP)
+
+
+def weekly_amounts():
+    with ORDERS_FILE.open() as file_d:
+        records = json.load(file_d)['RECORDS']
+    weeks = defaultdict(list)
+    for record in records:
+        if record['completed_at']:
+            year, week, _ = datetime.datetime.strptime(record['completed_at'], '%d/%m/%Y %H:%M:%S').isocalendar()
+            weeks[(int(record['merchant_id']), year, week)].append(decimal.Decimal(record['amount']))
+    return weeks
+
+
+def timed(function, weeks):
+    start = time.perf_counter()
+    result = {key: function(amounts) for key, amounts in weeks.items()}
+    return result, time.perf_counter() - start
+
+
+def main():
+    weeks = weekly_amounts()
+    exact_rates = (decimal.Decimal('0.01'), decimal.Decimal('0.0095'), decimal.Decimal('0.0085'))
+    float_rates = (decimal.Decimal(0.01), decimal.Decimal(0.0095), decimal.Decimal(0.0085))
+    weeks_cents = {key: [fees.to_cents(amount) for amount in amounts] for key, amounts in weeks.items()}
+
+    exact, exact_time = timed(lambda amounts: decimal_loop(amounts, exact_rates), weeks)
+    legacy, legacy_time = timed(lambda amounts: decimal_loop(amounts, float_rates), weeks)
+    cents, cents_time = timed(lambda amounts: fees.from_cents(fees.disbursed_cents(amounts)), weeks_cents)
+
+    keys = list(weeks_cents)
+    groups = [index for index, key in enumerate(keys) for _ in weeks_cents[key]]
+    amounts = [amount for key in keys for amount in weeks_cents[key]]
+    start = time.perf_counter()
+    batch = fees.disbursed_cents_by_merchant(groups, amounts)
+    batch_time = time.perf_counter() - start
+
+    mismatches = [key for key in weeks if cents[key] != exact[key]]
+    mismatches += [key for index, key in enumerate(keys) if fees.from_cents(batch[index]) != exact[key]]
+    legacy_differences = [key for key in weeks if legacy[key] != exact[key]]
+    print(f'orders: {sum(len(amounts) for amounts in weeks.values())}, merchant weeks: {len(weeks)}')
+    print(f'decimal loop: {exact_time:.4f}s, float rates loop: {legacy_time:.4f}s, cents engine: {cents_time:.4f}s, '
+          f'cents engine in one batch: {batch_time:.4f}s')
+    print(f'float rates loop differences: {len(legacy_differences)} {legacy_differences[:5]}')
+    assert not mismatches, f'Cents engine differs from the Decimal loop in {mismatches}'
+    print('cents engine matches the Decimal loop')
+
+
+if __name__ == "__main__":
+    main()
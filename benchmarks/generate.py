@@ -0,0 +1,86 @@
+"""
+    Synthetic seed data shaped like sequra/resources: merchants.json, shoppers.json and orders.json with the same
+    fields and formats, written record by record so multi-million order files do not have to fit in memory.
+
+    Usage: python -m benchmarks.generate --orders 1000000 --output /tmp/sequra-1m
+"""
+import argparse
+import datetime
+import json
+import random
+from pathlib import Path
+
+DATE_FORMAT = '%d/%m/%Y %H:%M:%S'
+# Share of the seed orders that are completed
+COMPLETED_RATIO = 0.84
+
+
+def _write_records(path: Path, records):
+    with path.open('w') as file_d:
+        file_d.write('{\n"RECORDS":[\n')
+        for index, record in enumerate(records):
+            if index:
+                file_d.write(',\n')
+            file_d.write(json.dumps(record, separators=(',', ':')))
+        file_d.write('\n]\n}\n')
+
+
+def _merchants(count):
+    for merchant_id in range(1, count + 1):
+        yield {'id': str(merchant_id), 'name': f'Merchant {merchant_id}', 'email': f'info@merchant-{merchant_id}.com',
+               'cif': f'B{611111110 + merchant_id}'}
+
+
+def _shoppers(count):
+    for shopper_id in range(1, count + 1):
+        yield {'id': str(shopper_id), 'name': f'Shopper {shopper_id}', 'email': f'shopper.{shopper_id}@not_gmail.com',
+               'nif': f'{411111110 + shopper_id}Z'}
+
+
+def _orders(count, merchants, shoppers, start, days, rng):
+    seconds = days * 24 * 3600
+    for order_id in range(1, count + 1):
+        created_at = start + datetime.timedelta(seconds=seconds * order_id // count)
+        completed_at = ''
+        if rng.random() < COMPLETED_RATIO:
+            completed_at = (created_at + datetime.timedelta(seconds=rng.randrange(7 * 24 * 3600))).strftime(DATE_FORMAT)
+        yield {'id': str(order_id),
+               'merchant_id': str(rng.randint(1, merchants)),
+               'shopper_id': str(rng.randint(1, shoppers)),
+               'amount': f'{rng.lognormvariate(4.5, 1.0):.2f}',
+               'created_at': created_at.strftime(DATE_FORMAT),
+               'completed_at': completed_at}
+
+
+def generate(output: Path, orders, merchants=None, shoppers=None, start=datetime.datetime(2018, 1, 1), days=365,
+             seed=0):
+    """ Writes the three seed files into output, merchants and shoppers scale with the orders by default """
+    merchants = merchants or max(10, orders // 2000)
+    shoppers = shoppers or max(100, orders // 10)
+    rng = random.Random(seed)
+    output.mkdir(parents=True, exist_ok=True)
+    _write_records(output / 'merchants.json', _merchants(merchants))
+    _write_records(output / 'shoppers.json', _shoppers(shoppers))
+    _write_records(output / 'orders.json', _orders(orders, merchants, shoppers, start, days, rng))
+    return {'orders': orders, 'merchants': merchants, 'shoppers': shoppers, 'days': days, 'seed': seed}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Generate synthetic seed data')
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--merchants', type=int)
+    parser.add_argument('--shoppers', type=int)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, required=True)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print(generate(args.output, orders=args.orders, merchants=args.merchants, shoppers=args.shoppers, days=args.days,
+                   seed=args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+    Load test of the read API in the WSGI serving mode: a file SQLite database is seeded and backfilled once,
+    then gunicorn serves it with every worker count while client threads poll GET /disbursement for every week,
+    as dashboards do. Throughput should grow with the workers up to the number of cores.
+
+    Usage: python -m benchmarks.load --workers 1 2 4 --threads 4 --clients 16 --seconds 10 [--output load.json]
+"""
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+from benchmarks.suite import percentile
+
+HOST = 'localhost:8888'
+YEAR = 2018
+
+
+def _get(url):
+    request = urllib.request.Request(url, headers={'Host': HOST})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        response.read()
+
+
+def _wait_until_ready(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited before serving')
+        try:
+            _get(f'{base_url}/metrics')
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise TimeoutError('gunicorn did not start')
+
+
+def load(base_url, clients, seconds):
+    """ Requests of clients threads during seconds, returns the latency statistics """
+    urls = itertools.cycle(f'{base_url}/disbursement?year={YEAR}&week={week}' for week in range(1, 53))
+    urls_lock = threading.Lock()
+    latencies, errors = [], []
+    deadline = time.monotonic() + seconds
+
+    def client():
+        while time.monotonic() < deadline:
+            with urls_lock:
+                url = next(urls)
+            start = time.perf_counter()
+            try:
+                _get(url)
+                latencies.append(time.perf_counter() - start)
+            except (urllib.error.URLError, ConnectionError) as error:
+                errors.append(error)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {'requests': len(latencies),
+            'errors': len(errors),
+            'throughput': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+            'p99_ms': percentile(latencies, 99) * 1000 if latencies else None}
+
+
+def serve(environment, workers, threads, port):
+    environment = dict(environment, SEQURA_WEB_WORKERS=str(workers), SEQURA_WEB_THREADS=str(threads),
+                       SEQURA_WEB_BIND=f'127.0.0.1:{port}')
+    return subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'sequra/resources/gunicorn.conf.py',
+                             'sequra.wsgi:application'], env=environment, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load test of GET /disbursement served by gunicorn')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=8899)
+    parser.add_argument('--output', type=Path, help='JSON file of the results')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        environment = dict(os.environ, SEQURA_DATABASE_URI=f'sqlite:///{directory}/sequra.db')
+        subprocess.run([sys.executable, '-m', 'sequra.backfill', '--start', f'{YEAR}-01-01', '--end',
+                        f'{YEAR}-12-31'], env=environment, check=True, stdout=subprocess.DEVNULL)
+        for workers in args.workers:
+            process = serve(environment, workers, args.threads, args.port)
+            try:
+                base_url = f'http://127.0.0.1:{args.port}'
+                _wait_until_ready(base_url, process)
+                results[workers] = load(base_url, args.clients, args.seconds)
+            finally:
+                process.terminate()
+                process.wait()
+            print(f'workers {workers}', json.dumps({key: round(value, 3) if isinstance(value, float) else value
+                                                    for key, value in results[workers].items()}))
+
+    report = {'config': {'cores': os.cpu_count(), 'threads': args.threads, 'clients': args.clients,
+                         'seconds': args.seconds},
+              'results': results}
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
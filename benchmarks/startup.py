@@ -0,0 +1,90 @@
+"""
+    Startup time of the entry points: every module is imported by a fresh interpreter run with python -X importtime,
+    whose report gives the cumulative import time and the slowest imports, then the app is created without and with
+    the API. Command line tools should not pay for the Flask-RESTX, Swagger and marshmallow stack.
+
+    Usage: python -m benchmarks.startup [--modules sequra.app sequra.batch] [--top 10] [--output startup.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+API_STACK = ('flask_restx', 'marshmallow')
+
+_CREATE_APP = '''
+import sys, time
+start = time.perf_counter()
+from sequra import app
+app.create_app(serve_api={serve_api})
+print(time.perf_counter() - start)
+print(' '.join(module for module in {api_stack} if module in sys.modules))
+'''
+
+
+def parse_importtime(report):
+    """ Self and cumulative microseconds of every imported module, from the stderr of python -X importtime """
+    modules = {}
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = {'self_us': int(self_us), 'cumulative_us': int(cumulative_us)}
+    return modules
+
+
+def import_time(module, top):
+    """ Import statistics of module in a fresh interpreter """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True,
+                               text=True, check=True)
+    modules = parse_importtime(completed.stderr)
+    slowest = sorted(modules.items(), key=lambda item: item[1]['self_us'], reverse=True)[:top]
+    return {'cumulative_ms': modules[module]['cumulative_us'] / 1000,
+            'modules': len(modules),
+            'api_stack': [name for name in API_STACK if name in modules],
+            'slowest_ms': {name: times['self_us'] / 1000 for name, times in slowest}}
+
+
+def create_app_time(serve_api, environment=None):
+    """ Seconds of the imports, migrations and setup of create_app in a fresh interpreter """
+    script = _CREATE_APP.format(serve_api=serve_api, api_stack=API_STACK)
+    lines = subprocess.run([sys.executable, '-c', script], env=environment, capture_output=True, text=True,
+                           check=True).stdout.splitlines()
+    return {'seconds': float(lines[-2]), 'api_stack': lines[-1].split()}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the startup time of the application and the tools')
+    parser.add_argument('--modules', nargs='+', default=['sequra.app', 'sequra.batch', 'sequra.snapshot',
+                                                         'sequra.wsgi'])
+    parser.add_argument('--top', type=int, default=10, help='slowest imports reported per module')
+    parser.add_argument('--output', type=Path, help='JSON file of the results')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = {'imports': {}, 'create_app': {}}
+    for module in args.modules:
+        report['imports'][module] = import_time(module, args.top)
+        result = report['imports'][module]
+        print(f'import {module}: {result["cumulative_ms"]:.1f}ms, {result["modules"]} modules, '
+              f'API stack: {", ".join(result["api_stack"]) or "no"}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        # A file database seeded once, as a restarted service finds it
+        environment = dict(os.environ, SEQURA_DATABASE_URI=f'sqlite:///{directory}/sequra.db')
+        create_app_time(False, environment)
+        for serve_api in (False, True):
+            report['create_app'][f'serve_api={serve_api}'] = result = create_app_time(serve_api, environment)
+            print(f'create_app(serve_api={serve_api}): {result["seconds"]:.3f}s, '
+                  f'API stack: {", ".join(result["api_stack"]) or "no"}')
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+    Benchmark suite of the disbursement pipeline on synthetic data: seeding, per merchant calculation,
+    all merchant weekly runs and the GET endpoints. Latencies are reported as p50/p99 in milliseconds with the
+    throughput of every step and the peak RSS of the process, and saved as JSON to compare runs.
+
+    The database is dropped and created again, so SEQURA_DATABASE_URI is ignored: it is in memory unless --database
+    gives another one, for example a SQLite file to measure a persistent database.
+
+    Usage: python -m benchmarks.suite --orders 100000 --output results.json [--compare previous.json]
+           [--database sqlite:////tmp/benchmark.db]
+"""
+import argparse
+import json
+import math
+import resource
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.generate import generate
+
+# A step slower than the compared run by more than this ratio is reported as a regression
+REGRESSION_RATIO = 1.2
+# Never the database of the environment, it is dropped
+IN_MEMORY_DATABASE = 'sqlite://'
+
+
+def percentile(values, percent):
+    """ Nearest-rank percentile """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(function, arguments):
+    """ Calls function once per argument, returns the latency statistics """
+    latencies = []
+    start = time.perf_counter()
+    for argument in arguments:
+        call_start = time.perf_counter()
+        function(argument)
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+    return {'count': len(latencies),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'throughput': len(latencies) / elapsed if elapsed else 0,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def run(data_dir: Path, samples, weeks, database_uri=IN_MEMORY_DATABASE):
+    from sequra import app as flask_app, settings
+    from sequra.batch import disburse_week
+    from sequra.cache import disbursement_cache
+    from sequra.database import db, init_db_seed
+    from sequra.database.models import Disbursement, Merchant, Order
+
+    settings.SQLALCHEMY_DATABASE_URI = database_uri
+    flask_app.initialize_app(flask_app.app)
+    db.init_app(flask_app.app)
+    results = {}
+    with flask_app.app.app_context():
+        db.drop_all()
+        db.create_all()
+        start = time.perf_counter()
+        init_db_seed(resources_dir=data_dir)
+        elapsed = time.perf_counter() - start
+        orders = Order.query.count()
+        results['seed'] = {'count': orders, 'seconds': elapsed, 'throughput': orders / elapsed,
+                           'peak_rss_mb': peak_rss_mb()}
+
+        merchants = Merchant.query.with_entities(Merchant.id, Merchant.name).order_by(Merchant.id).limit(
+            samples).all()
+        busiest = Order.query.with_entities(Order.completed_year, Order.completed_week).filter(
+            Order.completed_year.isnot(None)).group_by(Order.completed_year, Order.completed_week).order_by(
+            db.func.count().desc()).limit(weeks).all()
+        year, week = busiest[0]
+
+        results['calculate_amount'] = measure(
+            lambda merchant: Disbursement.calculate_amount(merchant_id=merchant.id, week=week, year=year), merchants)
+        results['disburse_week'] = measure(lambda year_week: disburse_week(*year_week), busiest)
+
+    with flask_app.app.test_client() as client:
+        def get(query_string):
+            disbursement_cache.clear()
+            response = client.get('/disbursement', query_string=query_string)
+            assert response.status_code == 200, response.data
+
+        results['get_disbursement'] = measure(get, [{'year': year, 'week': week, 'merchant_name': merchant.name}
+                                                    for merchant in merchants])
+        results['get_disbursements'] = measure(get, [{'year': year, 'week': week}] * samples)
+    return results
+
+
+def compare(results, previous):
+    """ Ratio of every p50 latency -or seconds- against the previous run """
+    ratios = {}
+    for step, current in results.items():
+        before = previous.get('results', {}).get(step)
+        if before:
+            key = 'p50_ms' if 'p50_ms' in current else 'seconds'
+            ratios[step] = current[key] / before[key] if before[key] else math.inf
+    return ratios
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the disbursement pipeline on synthetic data')
+    parser.add_argument('--orders', type=int, default=10000, help='from 10k to 10M orders')
+    parser.add_argument('--merchants', type=int)
+    parser.add_argument('--samples', type=int, default=50, help='merchants and requests timed per step')
+    parser.add_argument('--weeks', type=int, default=5, help='weeks disbursed for every merchant')
+    parser.add_argument('--data', type=Path, help='directory of generated data, reused when it exists')
+    parser.add_argument('--output', type=Path, help='JSON file of the results')
+    parser.add_argument('--compare', type=Path, help='JSON file of a previous run')
+    parser.add_argument('--database', default=IN_MEMORY_DATABASE,
+                        help='URI of the database dropped and created for the run, in memory by default')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        data_dir = args.data or Path(directory)
+        if not (data_dir / 'orders.json').exists():
+            generate(data_dir, orders=args.orders, merchants=args.merchants)
+        report = {'config': {'orders': args.orders, 'merchants': args.merchants, 'samples': args.samples,
+                             'weeks': args.weeks},
+                  'results': run(data_dir, samples=args.samples, weeks=args.weeks, database_uri=args.database)}
+
+    for step, result in report['results'].items():
+        print(step, json.dumps({key: round(value, 3) for key, value in result.items()}))
+    if args.compare:
+        ratios = compare(report['results'], json.loads(args.compare.read_text()))
+        report['compared_to'] = {'file': str(args.compare), 'ratios': ratios}
+        for step, ratio in ratios.items():
+            print(f'{step}: {ratio:.2f}x of {args.compare}' + (' REGRESSION' if ratio > REGRESSION_RATIO else ''))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
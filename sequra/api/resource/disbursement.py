@@ -1,14 +1,27 @@
 """Logic of handling requests to obtain competitors from a business"""
+import csv
+import io
 import logging
 from datetime import date
 
-from flask import request, abort
+from flask import abort, current_app, json, request, stream_with_context
 from flask_restx import Resource
 from marshmallow import Schema, fields
-from marshmallow.validate import Length, Range
+from marshmallow.validate import Length, OneOf, Range
+from sqlalchemy import and_, select
+from sqlalchemy.orm.exc import NoResultFound
 
+from sequra import fees, settings
+from sequra.api.resource.job import JobStatus
+from sequra.batch import calculate_week
+from sequra.backfill import backfill, iso_weeks
 from sequra.api.restx import api
-from sequra.database.models import Disbursement, Merchant
+from sequra.cache import disbursement_cache
+from sequra.database import db
+from sequra.database.models import BackfillWeek, Disbursement, DisbursementMonth, DisbursementYear, Merchant
+from sequra.directory import merchant_directory
+from sequra.jobs import job_queue
+from sequra.metrics import span
 
 log = logging.getLogger(__name__)
 
@@ -27,13 +40,50 @@ class DisbursementQuerySchema(Schema):
     merchant_name = fields.Str(required=False, validate=Length(1, 50))
     week = fields.Integer(required=True, validate=Range(min=1, min_inclusive=True, max=53, max_inclusive=True))
     year = fields.Integer(required=True, validate=Range(min=1980, max=3000))
+    after = fields.Integer(required=False, validate=Range(min=0))
+    limit = fields.Integer(required=False, validate=Range(min=1, max=settings.DISBURSEMENT_PAGE_MAX_SIZE))
+    format = fields.Str(required=False, validate=OneOf(['json', 'ndjson', 'csv']))
+
+
+ALL_MERCHANTS = 'all'
+
+
+class MerchantNames(fields.List):
+    """ List of merchant names, or "all" for every merchant """
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        if value == ALL_MERCHANTS:
+            return value
+        return super()._deserialize(value, attr, data, **kwargs)
+
+
+class BulkDisbursementSchema(Schema):
+    merchant_names = MerchantNames(fields.Str(validate=Length(1, 50)), required=True, validate=Length(min=1))
+    week = fields.Integer(required=True, validate=Range(min=1, min_inclusive=True, max=53, max_inclusive=True))
+    year = fields.Integer(required=True, validate=Range(min=1980, max=3000))
+
+
+class BackfillQuerySchema(Schema):
+    start = fields.Date(required=True)
+    end = fields.Date(required=True)
+
+
+MONTH, QUARTER, YEAR = 'month', 'quarter', 'year'
+
+
+class SummaryQuerySchema(Schema):
+    merchant_name = fields.Str(required=False, validate=Length(1, 50))
+    period = fields.Str(required=False, validate=OneOf([MONTH, QUARTER, YEAR]))
+    start = fields.Date(required=True)
+    end = fields.Date(required=True)
 
 
 @ns.route('/calculate_disbursement', doc={
     'description': 'Calculate and persist the disbursements per merchant on a given week and year asynchronously.'})
 class AsyncBusiness(Resource):
-    @api.response(200, 'Success')
-    @api.response(400, 'Merchant not found')
+    @api.response(202, 'Calculation enqueued')
+    @api.response(400, 'Invalid parameters')
+    @api.response(404, 'Merchant not found')
     @api.doc(params={'year': {'required': True}})
     @api.doc(params={'week': {'required': True}})
     @api.doc(params={'merchant_name': {'description': 'Merchant\'s name', 'max_length': 50, 'required': True}})
@@ -48,11 +98,48 @@ class AsyncBusiness(Resource):
         if week > self.weeks_for_year(year):
             abort(400, f'Input week number {week} is grater that number of weeks of year {year} ')
 
-        disbursement = Disbursement()
-        merchant = Merchant.query.filter(Merchant.name == merchant_name).one()
-        disbursement.save(week=week, year=year, merchant=merchant)
+        with span('merchant_lookup'):
+            merchant_id = merchant_directory.id_of(merchant_name)
+        if merchant_id is None:
+            abort(404, f'Merchant {merchant_name} not found')
+        job = job_queue.enqueue(merchant_id=merchant_id, week=week, year=year)
+
+        return job.asdict(), 202, {'Location': api.url_for(JobStatus, job_id=job.id)}
+
+    @api.response(201, 'Disbursements calculated and persisted')
+    @api.response(400, 'Invalid parameters')
+    @api.response(404, 'Merchant not found')
+    @api.doc(description='Calculate and persist the disbursements of many merchants -a list of names or "all"- '
+                         'on a given week and year, in one transaction.')
+    def post(self):
+        payload = request.get_json(silent=True) or {}
+        errors = BulkDisbursementSchema().validate(payload)
+        if errors:
+            abort(400, str(errors))
+        arguments = BulkDisbursementSchema().load(payload)
+        year = arguments['year']
+        week = arguments['week']
+        if week > self.weeks_for_year(year):
+            abort(400, f'Input week number {week} is grater that number of weeks of year {year} ')
+
+        with span('merchant_lookup'):
+            merchants = self.merchants(arguments['merchant_names'])
+        amounts = calculate_week(year=year, week=week, merchant_ids=list(merchants))
+        ids = Disbursement.bulk_upsert(week=week, year=year, amounts=amounts)
+        return {'week': week, 'year': year, 'disbursements': [
+            {'id': ids[merchant_id], 'merchant': name, 'amount': float(amounts[merchant_id])}
+            for merchant_id, name in merchants.items()]}, 201
 
-        return disbursement.id, 201
+    @staticmethod
+    def merchants(merchant_names):
+        """ Merchant name per id, ordered by id, resolved by the merchant directory """
+        if merchant_names == ALL_MERCHANTS:
+            return dict(sorted(merchant_directory.merchants().items()))
+        merchant_ids = {name: merchant_directory.id_of(name) for name in merchant_names}
+        missing = sorted(name for name, merchant_id in merchant_ids.items() if merchant_id is None)
+        if missing:
+            abort(404, f'Merchants not found: {", ".join(missing)}')
+        return dict(sorted((merchant_id, name) for name, merchant_id in merchant_ids.items()))
 
     @staticmethod
     def weeks_for_year(year):
@@ -67,24 +154,218 @@ class GetBusiness(Resource):
     @api.doc(params={'year': {'required': True}})
     @api.doc(params={'week': {'required': True}})
     @api.doc(params={'merchant_name': {'description': 'Merchant\'s name', 'max_length': 50, 'required': False}})
+    @api.doc(params={'after': {'description': 'Merchant id cursor, only merchants after it are returned'}})
+    @api.doc(params={'limit': {'description': 'Page size, the next cursor is returned in the X-Next-Cursor header'}})
+    @api.doc(params={'format': {'description': 'json, or ndjson and csv streamed row by row', 'enum': [
+        'json', 'ndjson', 'csv']}})
     def get(self):
         errors = DisbursementQuerySchema().validate(request.args)
         if errors:
             abort(400, str(errors))
         merchant_name = request.args.get('merchant_name')
-        year = request.args.get('year')
-        week = request.args.get('week')
-        if not merchant_name:
-            disbursements = Disbursement.query.join(Merchant, Merchant.id == Disbursement.merchant_id).filter(
+        year = int(request.args.get('year'))
+        week = int(request.args.get('week'))
+        merchant_id = None
+        if merchant_name:
+            with span('merchant_lookup'):
+                merchant_id = merchant_directory.id_of(merchant_name)
+            if merchant_id is None:
+                return []
+        else:
+            after = request.args.get('after', type=int)
+            limit = request.args.get('limit', type=int)
+            response_format = request.args.get('format', 'json')
+            if response_format != 'json':
+                return self.stream(response_format, year=year, week=week, after=after, limit=limit)
+            if after is not None or limit is not None:
+                return self.page(year=year, week=week, after=after, limit=limit)
+
+        key = (merchant_id, year, week)
+        body = disbursement_cache.get(key)
+        cache_status = 'HIT'
+        if body is None:
+            body = json.dumps(self.disbursements(merchant_id=merchant_id, year=year, week=week,
+                                                 merchant_name=merchant_name))
+            disbursement_cache.set(key, body)
+            cache_status = 'MISS'
+        return current_app.response_class(body, mimetype='application/json', headers={'X-Cache': cache_status})
+
+    @staticmethod
+    def disbursements(merchant_id, year, week, merchant_name=None):
+        """ The disbursement of a merchant is a probe of the (year, week, merchant) index, its name is already known """
+        with job_queue.read_connection() as connection:
+            if merchant_id is None:
+                return [{'amount': float(fees.from_cents(amount_cents)), 'week': week, 'year': year, 'merchant': name}
+                        for _, name, amount_cents in connection.execute(GetBusiness.rows(year=year, week=week))]
+            amount_cents = connection.execute(select([Disbursement.amount_cents]).where(and_(
+                Disbursement.week == week,
+                Disbursement.year == year,
+                Disbursement.merchant_id == merchant_id))).scalar()
+        if amount_cents is None:
+            raise NoResultFound()
+        return {'amount': float(fees.from_cents(amount_cents)), 'week': week, 'year': year, 'merchant': merchant_name}
+
+    @staticmethod
+    def rows(year, week, after=None, limit=None):
+        """ Statement of the disbursements of every merchant of the week as plain rows ordered by merchant id,
+        the after cursor is a merchant id so pages are index range scans instead of offsets.
+        Reads run on a connection of job_queue.read_connection, returned as soon as the rows are read, instead of the
+        session held until the request ends """
+        query = select([Disbursement.merchant_id, Merchant.name, Disbursement.amount_cents]).select_from(
+            Disbursement.__table__.join(Merchant.__table__)).where(and_(
                 Disbursement.week == week,
-                Disbursement.year == year).all()
-            return [dis.asdict() for dis in disbursements]
+                Disbursement.year == year))
+        if after is not None:
+            query = query.where(Disbursement.merchant_id > after)
+        query = query.order_by(Disbursement.merchant_id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
 
-        if not Merchant.query.filter(Merchant.name == merchant_name).scalar():
-            return []
+    def page(self, year, week, after, limit):
+        limit = limit or settings.DISBURSEMENT_PAGE_MAX_SIZE
+        with job_queue.read_connection() as connection:
+            rows = connection.execute(self.rows(year=year, week=week, after=after, limit=limit + 1)).fetchall()
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers['X-Next-Cursor'] = str(rows[-1].merchant_id)
+        return [{'amount': float(fees.from_cents(amount_cents)), 'week': week, 'year': year, 'merchant': name}
+                for _, name, amount_cents in rows], 200, headers
 
-        dis = Disbursement.query.join(Merchant, Disbursement.merchant).filter(
-            Merchant.name == merchant_name,
-            Disbursement.week == week,
-            Disbursement.year == year).one()
-        return dis.asdict()
+    def stream(self, response_format, year, week, after, limit):
+        """ Rows are written as they are fetched from a server-side cursor, the result set is never held whole """
+        rows = self._streamed_rows(self.rows(year=year, week=week, after=after, limit=limit))
+        if response_format == 'csv':
+            body, mimetype = self._csv_lines(rows, year, week), 'text/csv'
+        else:
+            body, mimetype = self._ndjson_lines(rows, year, week), 'application/x-ndjson'
+        return current_app.response_class(stream_with_context(body), mimetype=mimetype)
+
+    @staticmethod
+    def _streamed_rows(statement):
+        with job_queue.read_connection() as connection:
+            result = connection.execution_options(stream_results=True).execute(statement)
+            rows = result.fetchmany(settings.DISBURSEMENT_STREAM_BATCH_SIZE)
+            while rows:
+                yield from rows
+                rows = result.fetchmany(settings.DISBURSEMENT_STREAM_BATCH_SIZE)
+
+    @staticmethod
+    def _ndjson_lines(rows, year, week):
+        for _, name, amount_cents in rows:
+            yield json.dumps({'amount': float(fees.from_cents(amount_cents)), 'week': week, 'year': year,
+                              'merchant': name}) + '\n'
+
+    @staticmethod
+    def _csv_lines(rows, year, week):
+        line = io.StringIO()
+        writer = csv.writer(line)
+        writer.writerow(['merchant', 'year', 'week', 'amount'])
+        for _, name, amount_cents in rows:
+            yield line.getvalue()
+            line.seek(0)
+            line.truncate()
+            writer.writerow([name, year, week, fees.from_cents(amount_cents)])
+        yield line.getvalue()
+
+
+@ns.route('/disbursement/summary', doc={'description': 'Disbursed amounts and fees per merchant and month, quarter '
+                                                       'or year, from the periods of start to the ones of end.'})
+@api.doc(params={'start': {'description': 'A day of the first period, YYYY-MM-DD', 'required': True}})
+@api.doc(params={'end': {'description': 'A day of the last period, YYYY-MM-DD', 'required': True}})
+@api.doc(params={'period': {'description': 'month by default', 'enum': [MONTH, QUARTER, YEAR]}})
+@api.doc(params={'merchant_name': {'description': 'Merchant\'s name, every merchant by default', 'max_length': 50}})
+@api.response(400, 'Invalid parameters')
+class DisbursementSummary(Resource):
+    @api.response(200, 'Success')
+    def get(self):
+        errors = SummaryQuerySchema().validate(request.args)
+        if errors:
+            abort(400, str(errors))
+        arguments = SummaryQuerySchema().load(request.args)
+        if arguments['start'] > arguments['end']:
+            abort(400, 'start must not be after end')
+        merchant_id = None
+        if arguments.get('merchant_name'):
+            with span('merchant_lookup'):
+                merchant_id = merchant_directory.id_of(arguments['merchant_name'])
+            if merchant_id is None:
+                return []
+        return self.totals(arguments.get('period', MONTH), arguments['start'], arguments['end'],
+                           merchant_id=merchant_id)
+
+    @staticmethod
+    def totals(period, start, end, merchant_id=None):
+        """ Read from the rollups, a row per merchant and period instead of one per merchant and week.
+        Quarters are summed from the months """
+        if period == YEAR:
+            rollup = DisbursementYear
+            query = select([rollup.merchant_id, Merchant.name, rollup.year, rollup.amount_cents, rollup.fee_cents,
+                            rollup.disbursements]).order_by(rollup.merchant_id, rollup.year)
+        else:
+            rollup = DisbursementMonth
+            first, last = start.year * 12 + start.month - 1, end.year * 12 + end.month - 1
+            if period == QUARTER:
+                first, last = first - first % 3, last - last % 3 + 2
+            query = select([rollup.merchant_id, Merchant.name, rollup.year, rollup.month, rollup.amount_cents,
+                            rollup.fee_cents, rollup.disbursements]).where(
+                (rollup.year * 12 + rollup.month - 1).between(first, last)).order_by(
+                rollup.merchant_id, rollup.year, rollup.month)
+        query = query.select_from(rollup.__table__.join(Merchant.__table__)).where(
+            rollup.year.between(start.year, end.year))
+        if merchant_id is not None:
+            query = query.where(rollup.merchant_id == merchant_id)
+        with job_queue.read_connection() as connection:
+            rows = connection.execute(query).fetchall()
+
+        totals = {}
+        for row in rows:
+            key = (row.merchant_id, row.name, DisbursementSummary.label(period, row))
+            amount_cents, fee_cents, disbursements = totals.get(key, (0, 0, 0))
+            totals[key] = (amount_cents + row.amount_cents, fee_cents + row.fee_cents,
+                           disbursements + row.disbursements)
+        return [{'merchant': name, 'period': label, 'amount': float(fees.from_cents(amount_cents)),
+                 'fees': float(fees.from_cents(fee_cents)), 'disbursements': disbursements}
+                for (_, name, label), (amount_cents, fee_cents, disbursements) in totals.items()]
+
+    @staticmethod
+    def label(period, row):
+        """ 2018, 2018-Q1 or 2018-01 """
+        if period == YEAR:
+            return str(row.year)
+        if period == QUARTER:
+            return f'{row.year}-Q{(row.month - 1) // 3 + 1}'
+        return f'{row.year}-{row.month:02d}'
+
+
+@ns.route('/backfill', doc={'description': 'Disbursements of every merchant for every week of a date range, '
+                                           'calculated in a single sweep of the orders.'})
+@api.doc(params={'start': {'description': 'First day, YYYY-MM-DD', 'required': True}})
+@api.doc(params={'end': {'description': 'Last day, YYYY-MM-DD', 'required': True}})
+@api.response(400, 'Invalid parameters')
+class Backfill(Resource):
+    @api.response(200, 'Progress of the weeks of the range')
+    def get(self):
+        start, end = self.date_range()
+        weeks = iso_weeks(start, end)
+        done = BackfillWeek.done(weeks)
+        return {'weeks': len(weeks), 'done': len(done),
+                'pending': [{'year': year, 'week': week} for year, week in weeks if (year, week) not in done]}
+
+    @api.response(202, 'Backfill enqueued')
+    def post(self):
+        start, end = self.date_range()
+        job_queue.submit(backfill, start, end)
+        return {'weeks': len(iso_weeks(start, end))}, 202, {'Location': api.url_for(
+            Backfill, start=start.isoformat(), end=end.isoformat())}
+
+    @staticmethod
+    def date_range():
+        errors = BackfillQuerySchema().validate(request.args)
+        if errors:
+            abort(400, str(errors))
+        arguments = BackfillQuerySchema().load(request.args)
+        if arguments['start'] > arguments['end']:
+            abort(400, 'start must not be after end')
+        return arguments['start'], arguments['end']
@@ -0,0 +1,19 @@
+"""Logic of handling requests to follow the background jobs"""
+import logging
+
+from flask_restx import Resource
+
+from sequra.api.restx import api
+from sequra.database.models import Job
+
+log = logging.getLogger(__name__)
+
+ns = api.namespace('jobs', description='Background jobs API')
+
+
+@ns.route('/<int:job_id>', doc={'description': 'Status of a disbursement calculation job.'})
+@api.response(200, 'Success')
+@api.response(404, 'Job not found')
+class JobStatus(Resource):
+    def get(self, job_id):
+        return Job.query.filter(Job.id == job_id).one().asdict()
@@ -0,0 +1,65 @@
+"""Logic of handling requests to ingest order events"""
+import logging
+
+from flask import abort, json, request
+from flask_restx import Resource
+from marshmallow import Schema, ValidationError, fields, validates_schema
+from marshmallow.validate import OneOf, Range
+
+from sequra.api.restx import api
+from sequra.directory import merchant_directory
+from sequra.ingest import COMPLETE, CREATE, ingest_buffer
+
+log = logging.getLogger(__name__)
+
+ns = api.namespace('orders', description='Orders API')
+
+
+class OrderEventSchema(Schema):
+    """A create event carries the whole order, completed or not, a complete event only the order id and its date"""
+    type = fields.Str(required=True, validate=OneOf([CREATE, COMPLETE]))
+    id = fields.Integer(required=True, validate=Range(min=1))
+    merchant_id = fields.Integer(validate=Range(min=1))
+    shopper_id = fields.Integer(validate=Range(min=1))
+    amount = fields.Decimal(validate=Range(min=0))
+    created_at = fields.DateTime()
+    completed_at = fields.DateTime(allow_none=True)
+
+    @validates_schema
+    def validate_event(self, data, **kwargs):
+        required = ('merchant_id', 'shopper_id', 'amount', 'created_at') if data['type'] == CREATE else (
+            'completed_at',)
+        missing = {field: ['Missing data for required field.'] for field in required if data.get(field) is None}
+        if missing:
+            raise ValidationError(missing)
+
+
+@ns.route('', doc={'description': 'Order create and complete events, as a JSON array or NDJSON, written in batches.'})
+class Orders(Resource):
+    @api.response(202, 'Events accepted')
+    @api.response(400, 'Invalid events')
+    @api.response(503, 'Too many events waiting to be written')
+    def post(self):
+        try:
+            events = OrderEventSchema(many=True).load(self.payload())
+        except ValidationError as error:
+            abort(400, str(error.messages))
+        merchant_ids = merchant_directory.merchants()
+        unknown = sorted({event['merchant_id'] for event in events if event['type'] == CREATE} - set(merchant_ids))
+        if unknown:
+            abort(400, f'Merchants not found: {", ".join(map(str, unknown))}')
+        if not ingest_buffer.add(events):
+            abort(503, 'Too many order events waiting to be written, retry later')
+        return {'accepted': len(events), 'queue_depth': ingest_buffer.depth}, 202
+
+    @staticmethod
+    def payload():
+        try:
+            if request.mimetype == 'application/x-ndjson':
+                return [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+            payload = json.loads(request.get_data(as_text=True))
+        except ValueError as error:
+            abort(400, f'Invalid JSON: {error}')
+        if not isinstance(payload, list):
+            abort(400, 'A JSON array of order events is required')
+        return payload
@@ -1,9 +1,12 @@
 import logging
 import traceback
 
-from flask_restx import Api
+from flask import current_app
+from flask_restx import Api, Resource
 from sqlalchemy.orm.exc import NoResultFound
 
+from sequra.metrics import registry
+
 log = logging.getLogger(__name__)
 
 api = Api(version='1.0', title='Disbursement API', description='Using Flask RestPlus with Swagger')
@@ -21,3 +24,10 @@ def database_not_found_error_handler(error):
     log.warning(traceback.format_exc())
     log.error(error)
     return {'message': 'A database result was required but none was found.'}, 404
+
+
+@api.route('/metrics', doc=False)
+class Metrics(Resource):
+    def get(self):
+        """ Request, SQL and calculation metrics in the Prometheus text format """
+        return current_app.response_class(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -11,16 +11,24 @@ from pathlib import Path
 from flask import Flask, Blueprint
 
 from sequra import settings
-from sequra.api.resource.disbursement import ns as place_namespace
-from sequra.api.restx import api
-from sequra.database import db, init_db_seed
+from sequra.database import db, engine_options
 
 app = Flask(__name__)
-logging.config.fileConfig(Path(__file__).parent / './resources' / 'logging.conf')
 log = logging.getLogger(__name__)
 
+_LOGGING_CONFIG = Path(__file__).parent / './resources' / 'logging.conf'
+_logging_configured = False
+
+
+def configure_logging():
+    global _logging_configured  # pylint: disable=global-statement
+    if not _logging_configured:
+        logging.config.fileConfig(_LOGGING_CONFIG, disable_existing_loggers=False)
+        _logging_configured = True
+
 
 def configure_app(flask_app):
+    configure_logging()
     flask_app.config['SERVER_NAME'] = settings.FLASK_SERVER_NAME
     flask_app.config['FLASK_ENV'] = settings.FLASK_ENV
     flask_app.config['RESTPLUS_VALIDATE'] = settings.RESTPLUS_VALIDATE
@@ -28,27 +36,62 @@ def configure_app(flask_app):
     flask_app.config['SQLALCHEMY_DATABASE_URI'] = settings.SQLALCHEMY_DATABASE_URI
     flask_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = settings.SQLALCHEMY_TRACK_MODIFICATIONS
     flask_app.config['SQLALCHEMY_ECHO'] = settings.SQLALCHEMY_ECHO
+    flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(settings.SQLALCHEMY_DATABASE_URI)
 
 
 def initialize_app(flask_app):
+    """ Registers the API, its Swagger, marshmallow and flask_restx stack is only imported here """
+    from sequra import metrics
+    from sequra.api.resource.disbursement import ns as place_namespace
+    from sequra.api.resource.job import ns as job_namespace
+    from sequra.api.resource.order import ns as order_namespace
+    from sequra.api.restx import api
+    from sequra.ingest import ingest_buffer
+    from sequra.jobs import job_queue
+
     configure_app(flask_app)
+    if 'api' in flask_app.blueprints:
+        return
 
     blueprint = Blueprint('api', __name__, url_prefix='/')
     api.init_app(blueprint)
     api.add_namespace(place_namespace)
+    api.add_namespace(job_namespace)
+    api.add_namespace(order_namespace)
     flask_app.register_blueprint(blueprint)
+    job_queue.init_app(flask_app)
+    ingest_buffer.init_app(flask_app)
+    metrics.init_app(flask_app)
 
 
-def initialize_db():
+def initialize_db(serve_api=True):
+    """ Applies the pending migrations -seeding an empty database- and, for the API, loads the merchant directory and
+    resumes the unfinished jobs """
+    from sequra.database.migrations import migrate, reseed
     db.init_app(app)
     with app.app_context():
-        db.create_all()
-        init_db_seed()
+        if 2 not in migrate() and settings.SEED_DATABASE == 'always':
+            reseed()
+        if serve_api:
+            from sequra.directory import merchant_directory
+            from sequra.jobs import job_queue
+            merchant_directory.load()
+            job_queue.resume()
+
+
+def create_app(serve_api=True):
+    """ Application of the WSGI workers, every worker calls it. Migrations are applied once per database so workers
+    starting together against a persistent database seed it only once.
+    Command line tools pass serve_api=False: only the models and the fee engine are imported """
+    configure_app(app)
+    if serve_api:
+        initialize_app(app)
+    initialize_db(serve_api=serve_api)
+    return app
 
 
 def main():
-    initialize_app(app)
-    initialize_db()
+    create_app()
     app.run(debug=settings.FLASK_DEBUG)
 
 
@@ -0,0 +1,137 @@
+"""
+    Backfill
+    ========
+
+    Calculates and persists the disbursements of every merchant for every ISO week of a date range.
+    The completed orders of the range are swept once in completed_at order, each week is written as soon as the
+    sweep leaves it and checkpointed, so a backfill run again skips the weeks already done.
+
+    Usage: python sequra/backfill.py --start 2018-01-01 --end 2018-12-31 [--processes 4]
+"""
+import argparse
+import datetime
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+
+from sequra import fees, settings
+from sequra.database import db
+from sequra.database.models import BackfillWeek, Disbursement, Merchant, Order
+
+log = logging.getLogger(__name__)
+
+ONE_WEEK = datetime.timedelta(weeks=1)
+
+
+def iso_weeks(start, end):
+    """ (year, week) of every ISO week from the week of start to the week of end, both included """
+    monday = datetime.date.fromisocalendar(*start.isocalendar()[:2], 1)
+    weeks = []
+    while monday <= end:
+        weeks.append(tuple(monday.isocalendar()[:2]))
+        monday += ONE_WEEK
+    return weeks
+
+
+def _monday(year, week):
+    return datetime.datetime.combine(datetime.date.fromisocalendar(year, week, 1), datetime.time())
+
+
+def _write_week(year, week, merchant_ids, orders):
+    """ orders are (merchant id, amount in cents) """
+    orders = sorted(orders)
+    disbursed = fees.disbursed_cents_by_merchant(np.array([merchant_id for merchant_id, _ in orders], dtype=np.int64),
+                                                 np.array([cents for _, cents in orders], dtype=np.int64))
+    amounts = {merchant_id: fees.from_cents(disbursed.get(merchant_id, 0)) for merchant_id in merchant_ids}
+    Disbursement.bulk_upsert(week=week, year=year, amounts=amounts)
+    BackfillWeek.checkpoint(db.session.connection(), year=year, week=week, merchants=len(amounts), orders=len(orders))
+    db.session.commit()
+
+
+def backfill(start, end, merchant_ids=None):
+    """ Returns the number of weeks written, weeks already checkpointed are skipped """
+    weeks = iso_weeks(start, end)
+    done = BackfillWeek.done(weeks)
+    pending = [week for week in weeks if week not in done]
+    if not pending:
+        log.info('Every week between %s and %s is already backfilled', start, end)
+        return 0
+    if merchant_ids is None:
+        merchant_ids = [merchant_id for merchant_id, in Merchant.query.with_entities(Merchant.id)]
+
+    sweep = weeks[weeks.index(pending[0]):weeks.index(pending[-1]) + 1]
+    rows = db.session.query(Order.completed_year, Order.completed_week, Order.merchant_id, Order.amount_cents).filter(
+        Order.completed_at >= _monday(*sweep[0]),
+        Order.completed_at < _monday(*sweep[-1]) + ONE_WEEK).order_by(
+        Order.completed_at).yield_per(settings.BACKFILL_BATCH_SIZE)
+    orders_by_week = groupby(rows, key=itemgetter(0, 1))
+    week_key, week_orders = next(orders_by_week, (None, ()))
+
+    written = 0
+    for year, week in sweep:
+        orders = []
+        if week_key == (year, week):
+            orders = [(merchant_id, cents) for _, _, merchant_id, cents in week_orders]
+            week_key, week_orders = next(orders_by_week, (None, ()))
+        if (year, week) in done:
+            continue
+        _write_week(year, week, merchant_ids, orders)
+        written += 1
+        log.info('Backfilled week %s of %s, %s orders, %s/%s weeks', week, year, len(orders), written, len(pending))
+    return written
+
+
+def _split(weeks, parts):
+    """ Contiguous (start, end) date ranges of weeks, one per part """
+    size = -(-len(weeks) // parts)
+    chunks = [weeks[index:index + size] for index in range(0, len(weeks), size)]
+    return [(datetime.date.fromisocalendar(*chunk[0], 1), datetime.date.fromisocalendar(*chunk[-1], 7))
+            for chunk in chunks]
+
+
+def _backfill_process(start, end):
+    from sequra import app as flask_app
+    flask_app.configure_app(flask_app.app)
+    db.init_app(flask_app.app)
+    with flask_app.app.app_context():
+        return backfill(start, end)
+
+
+def backfill_parallel(start, end, processes):
+    """ Splits the range in contiguous parts swept by a pool of processes, they must share a persistent database
+    already migrated """
+    ranges = _split(iso_weeks(start, end), processes)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return sum(executor.map(_backfill_process, *zip(*ranges)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Calculate the disbursements of every merchant for a date range')
+    parser.add_argument('--start', type=datetime.date.fromisoformat, required=True)
+    parser.add_argument('--end', type=datetime.date.fromisoformat, required=True)
+    parser.add_argument('--processes', type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from sequra import app as flask_app
+    from sequra.jobs import is_single_connection
+    args = parse_args(argv)
+    if args.processes > 1 and is_single_connection(settings.SQLALCHEMY_DATABASE_URI):
+        raise SystemExit('Several processes require a database shared between processes')
+    flask_app.create_app(serve_api=False)
+    if args.processes > 1:
+        with flask_app.app.app_context():
+            # The processes forked open their own connections
+            db.engine.dispose()
+        backfill_parallel(args.start, args.end, args.processes)
+        return
+    with flask_app.app.app_context():
+        backfill(args.start, args.end)
+
+
+if __name__ == "__main__":
+    main()
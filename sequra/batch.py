@@ -0,0 +1,56 @@
+"""
+    Batch disbursement
+    ==================
+
+    Calculates and persists the disbursements of every merchant for a given week in one pass:
+    the completed orders of the week are read once, grouped by merchant and written in a single transaction.
+
+    Usage: python sequra/batch.py --year 2018 --week 2
+"""
+import argparse
+import logging
+
+from sequra import fees, settings
+from sequra.database.models import Disbursement, DisbursementAccumulator, Merchant, Order
+
+log = logging.getLogger(__name__)
+
+
+def calculate_week(year, week, merchant_ids=None):
+    """ Disbursed amount per merchant id, merchants without completed orders in the week are disbursed 0.
+    Only the rows of merchant_ids are read, so shards of merchants do not read the whole week each """
+    selected = merchant_ids
+    if merchant_ids is None:
+        merchant_ids = [merchant_id for merchant_id, in Merchant.query.with_entities(Merchant.id)]
+    if settings.INCREMENTAL_DISBURSEMENTS:
+        disbursed = DisbursementAccumulator.amounts_in_week(week=week, year=year, merchant_ids=selected)
+    else:
+        disbursed = fees.disbursed_cents_by_merchant(*Order.amounts_in_week(week=week, year=year,
+                                                                            merchant_ids=selected))
+    return {merchant_id: fees.from_cents(disbursed.get(merchant_id, 0)) for merchant_id in merchant_ids}
+
+
+def disburse_week(year, week, merchant_ids=None):
+    amounts = calculate_week(year=year, week=week, merchant_ids=merchant_ids)
+    written = Disbursement.bulk_upsert(week=week, year=year, amounts=amounts)
+    log.info('Disbursed %s merchants for week %s of %s', len(written), week, year)
+    return amounts
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Calculate the disbursements of every merchant for a week')
+    parser.add_argument('--year', type=int, required=True)
+    parser.add_argument('--week', type=int, required=True)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from sequra import app as flask_app
+    args = parse_args(argv)
+    flask_app.create_app(serve_api=False)
+    with flask_app.app.app_context():
+        disburse_week(year=args.year, week=args.week)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+    Cache
+    =====
+
+    In-process LRU cache with a time to live per entry, used to keep serialized API responses.
+    A cache given a version -read from the database- is emptied when the version changed, checked at most every
+    check_interval seconds, so writes of other processes are seen without waiting for the time to live.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from sequra import settings
+from sequra.metrics import CallbackMetric, registry
+
+
+class ResponseCache:
+
+    def __init__(self, maxsize, ttl, version=None, check_interval=0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version_of = version
+        self._version = None
+        self._checked_at = None
+
+    def get(self, key):
+        self._check_version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+            self._checked_at = None
+
+    def _check_version(self):
+        if self._version_of is None:
+            return
+        with self._lock:
+            now = self._clock()
+            if self._checked_at is not None and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+        version = self._version_of()
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0}
+
+
+def disbursement_version():
+    """ Version of the disbursement table, incremented by every process writing disbursements. The in-memory database
+    lives in a single process, whose writes already invalidate the cache """
+    from flask import current_app
+    from sequra.database import db
+    from sequra.database.models import Disbursement, TableVersion
+    from sequra.jobs import is_single_connection
+    if is_single_connection(current_app.config.get('SQLALCHEMY_DATABASE_URI')):
+        return None
+    with db.engine.connect() as connection:
+        return TableVersion.current(Disbursement.__tablename__, connection)
+
+
+# Keys are (merchant id, year, week), merchant id None for the response with every merchant of the week
+disbursement_cache = ResponseCache(maxsize=settings.DISBURSEMENT_CACHE_SIZE, ttl=settings.DISBURSEMENT_CACHE_TTL,
+                                   version=disbursement_version,
+                                   check_interval=settings.DISBURSEMENT_CACHE_CHECK_INTERVAL)
+registry.register(CallbackMetric('sequra_disbursement_cache_hits_total', 'Disbursement responses served from the cache.',
+                                 'counter', lambda: disbursement_cache.hits))
+registry.register(CallbackMetric('sequra_disbursement_cache_misses_total', 'Disbursement responses not in the cache.',
+                                 'counter', lambda: disbursement_cache.misses))
@@ -0,0 +1,177 @@
+"""
+    Migrations
+    ==========
+
+    Versioned changes applied once per database instead of creating and seeding the schema on every start.
+    Each migration runs in its own transaction holding a database wide lock, so several workers starting against
+    the same database apply it only once.
+
+    New schema changes are appended to MIGRATIONS with the next version.
+"""
+import logging
+
+from sqlalchemy import func, inspect, select
+from sqlalchemy.exc import DBAPIError
+
+from sequra import settings
+from sequra.database import db, init_db_seed
+
+log = logging.getLogger(__name__)
+
+schema_version = db.Table('schema_version', db.Column('version', db.Integer, primary_key=True))
+
+# Arbitrary key of the PostgreSQL advisory lock taken while migrating
+_LOCK_KEY = 724101
+
+
+def _initial_schema():
+    from sequra.database import models  # pylint: disable=unused-import
+    db.metadata.create_all(bind=db.session.connection())
+
+
+def _seed():
+    """ Loads the seed files into an empty database, unless settings.SEED_DATABASE is 'never' """
+    from sequra.database.models import Merchant
+    if settings.SEED_DATABASE == 'never':
+        log.info('Seeding skipped, SEQURA_SEED is never')
+    elif db.session.query(Merchant.query.exists()).scalar():
+        log.info('Seeding skipped, the database already has merchants')
+    else:
+        init_db_seed()
+
+
+def reseed():
+    """ Replaces the merchants, shoppers and orders by the seed files, with everything calculated from them """
+    from sequra.database.models import (BackfillWeek, Disbursement, DisbursementAccumulator, DisbursementMonth,
+                                        DisbursementYear, Job, Merchant, Order, ScheduledShard, Shopper)
+    _lock()
+    for model in (Job, Disbursement, DisbursementMonth, DisbursementYear, DisbursementAccumulator, BackfillWeek,
+                  ScheduledShard, Order, Shopper, Merchant):
+        db.session.execute(model.__table__.delete())
+    log.info('Reseeding, SEQURA_SEED is always')
+    init_db_seed()
+    db.session.commit()
+
+
+def _unique_disbursement_week():
+    """ Keeps the last disbursement of every merchant and week and makes their index unique """
+    from sequra.database.models import Disbursement
+    connection = db.session.connection()
+    index, = (index for index in Disbursement.__table__.indexes if index.name == 'ix_disbursement_year_week_merchant')
+    existing = {found['name']: found for found in inspect(connection).get_indexes(Disbursement.__tablename__)}
+    if existing.get(index.name, {}).get('unique'):
+        return
+    kept = select([func.max(Disbursement.id)]).group_by(Disbursement.merchant_id, Disbursement.year, Disbursement.week)
+    connection.execute(Disbursement.__table__.delete().where(Disbursement.id.notin_(kept)))
+    if index.name in existing:
+        index.drop(bind=connection)
+    index.create(bind=connection)
+
+
+def _table_versions():
+    from sequra.database.models import TableVersion
+    TableVersion.__table__.create(bind=db.session.connection(), checkfirst=True)
+
+
+def _scheduled_shards():
+    from sequra.database.models import ScheduledShard
+    ScheduledShard.__table__.create(bind=db.session.connection(), checkfirst=True)
+
+
+def _disbursement_rollups():
+    """ Adds the fees of every disbursement and sums them with the amounts by merchant, month and year """
+    from sequra.database.models import Disbursement, DisbursementMonth, DisbursementYear, Order, rebuild_rollups
+    connection = db.session.connection()
+    columns = {column['name'] for column in inspect(connection).get_columns(Disbursement.__tablename__)}
+    if 'fee_cents' not in columns:
+        connection.execute(f'ALTER TABLE {Disbursement.__tablename__} ADD COLUMN fee_cents INTEGER')
+    disbursement, order = Disbursement.__table__, Order.__table__
+    ordered = select([func.coalesce(func.sum(order.c.amount_cents), 0)]).where(
+        order.c.merchant_id == disbursement.c.merchant_id).where(
+        order.c.completed_year == disbursement.c.year).where(
+        order.c.completed_week == disbursement.c.week).as_scalar()
+    connection.execute(disbursement.update().where(disbursement.c.fee_cents.is_(None)).values(
+        fee_cents=disbursement.c.amount_cents - ordered))
+    DisbursementMonth.__table__.create(bind=connection, checkfirst=True)
+    DisbursementYear.__table__.create(bind=connection, checkfirst=True)
+    rebuild_rollups(connection)
+
+
+def _accumulated_order_amounts():
+    """ Adds the order amounts to the accumulators, recomputed from the completed orders """
+    from sequra.database.models import DisbursementAccumulator
+    connection = db.session.connection()
+    table = DisbursementAccumulator.__table__
+    if 'amount_cents' not in {column['name'] for column in inspect(connection).get_columns(table.name)}:
+        connection.execute(f'ALTER TABLE {table.name} ADD COLUMN amount_cents BIGINT NOT NULL DEFAULT 0')
+    DisbursementAccumulator.replace_all(connection)
+
+
+def _job_claims():
+    from sequra.database.models import Job
+    connection = db.session.connection()
+    existing = {column['name'] for column in inspect(connection).get_columns(Job.__tablename__)}
+    for column in (Job.__table__.c.owner, Job.__table__.c.claimed_at):
+        if column.name not in existing:
+            connection.execute(f'ALTER TABLE {Job.__tablename__} ADD COLUMN {column.name} '
+                               f'{column.type.compile(dialect=connection.dialect)}')
+
+
+def _fixed_range_shards():
+    """ Checkpoints of shards cut by number of merchants do not match the fixed ranges of ids, a week run again
+    disburses all its shards """
+    from sequra.database.models import ScheduledShard
+    db.session.execute(ScheduledShard.__table__.delete())
+
+
+MIGRATIONS = (
+    (1, 'Initial schema', _initial_schema),
+    (2, 'Seed merchants, shoppers and orders', _seed),
+    (3, 'Unique disbursement per merchant and week', _unique_disbursement_week),
+    (4, 'Table versions', _table_versions),
+    (5, 'Scheduled shard checkpoints', _scheduled_shards),
+    (6, 'Disbursement fees and monthly and yearly rollups', _disbursement_rollups),
+    (7, 'Order amounts of the disbursement accumulators', _accumulated_order_amounts),
+    (8, 'Job claims', _job_claims),
+    (9, 'Scheduled shards of fixed ranges of merchant ids', _fixed_range_shards),
+)
+
+
+def _lock():
+    """ Blocks other migrating processes until the transaction ends """
+    if db.session.bind.dialect.name == 'postgresql':
+        db.session.execute(select([func.pg_advisory_xact_lock(_LOCK_KEY)]))
+    else:
+        # SQLite takes its database write lock on the first write of a transaction
+        db.session.execute(schema_version.update().values(version=schema_version.c.version))
+
+
+def _create_schema_version():
+    """ Processes starting together, as the WSGI workers do, may all find the table missing before the migration lock
+    exists: the ones losing the race find it created by the winner """
+    try:
+        schema_version.create(bind=db.engine, checkfirst=True)
+    except DBAPIError:
+        if not db.engine.has_table(schema_version.name):
+            raise
+
+
+def current_version():
+    return db.session.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+
+def migrate():
+    """ Applies the pending migrations, returns the versions applied """
+    _create_schema_version()
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        _lock()
+        if version <= current_version():
+            db.session.rollback()
+            continue
+        log.info('Applying migration %s: %s', version, description)
+        db.session.execute(schema_version.insert().values(version=version))
+        migration()
+        db.session.commit()
+        applied.append(version)
+    return applied
@@ -1,9 +1,60 @@
+import datetime
 import decimal
 
-from sqlalchemy import extract
-from sqlalchemy.orm import validates
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session, object_session, validates
+from sqlalchemy.orm.attributes import get_history
 
-from sequra.database import db
+from sequra import fees, settings
+from sequra.cache import disbursement_cache
+from sequra.database import Upsert, db
+from sequra.directory import merchant_directory
+from sequra.metrics import timed
+
+
+def month_of_week(year, week):
+    """ Calendar month of an ISO week, the month of its Thursday: as an ISO year is the year of the Thursdays of its
+    weeks, the months of a year hold exactly its weeks """
+    return datetime.date.fromisocalendar(year, week, 4).month
+
+
+def weeks_of_month(year, month):
+    """ ISO weeks of a calendar month, the weeks whose Thursday is in the month """
+    thursday = datetime.date(year, month, 1)
+    thursday += datetime.timedelta(days=(3 - thursday.weekday()) % 7)
+    weeks = []
+    while thursday.month == month:
+        weeks.append(thursday.isocalendar()[1])
+        thursday += datetime.timedelta(weeks=1)
+    return weeks
+
+
+# Above this many merchants, reads of some merchants filter the range of their ids instead of listing them
+MERCHANT_LIST_MAX_SIZE = 500
+# Accumulated (scaled_amount, orders, amount_cents) of a week without completed orders
+_NOTHING_ACCUMULATED = (0, 0, 0)
+# Class of the PostgreSQL advisory locks of the rollups of a merchant, the second key is the merchant id
+_ROLLUP_LOCK_CLASS = 724102
+# Session info key of the disbursements written in the transaction, invalidated in the cache when it commits
+_WRITTEN_DISBURSEMENTS = 'written_disbursements'
+
+
+def merchant_filter(column, merchant_ids):
+    """ Restricts column to merchant_ids: an IN list for a few merchants, their id range for more, as the consecutive
+    ids of a shard, the rows of other merchants in the range are left to the caller """
+    merchant_ids = list(merchant_ids)
+    if len(merchant_ids) <= MERCHANT_LIST_MAX_SIZE:
+        return column.in_(merchant_ids)
+    return column.between(min(merchant_ids), max(merchant_ids))
+
+
+def iso_year_week(completed_at):
+    """ ISO 8601 year and week of a completion date, (None, None) for orders not completed """
+    if completed_at is None:
+        return None, None
+    year, week, _ = completed_at.isocalendar()
+    return year, week
 
 
 @validates('email')
@@ -15,65 +66,437 @@ def validate_email(key, address):
 
 class Disbursement(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    _amount = db.Column("amount", db.String(50))
+    amount_cents = db.Column(db.Integer)
+    # Fees included in the amount, the amount minus the completed order amounts of the week
+    fee_cents = db.Column(db.Integer)
     week = db.Column(db.Integer)
     year = db.Column(db.Integer)
 
     merchant_id = db.Column(db.Integer, db.ForeignKey('merchant.id'), nullable=False)
 
     merchant = db.relationship('Merchant', backref=db.backref('disbursements', lazy='dynamic'))
-    db.UniqueConstraint('week', 'week', name='unique_disbursement_week_year')
+
+    # A single disbursement per merchant and week, the index is the lookup path of every read by week
+    __table_args__ = (
+        db.Index('ix_disbursement_year_week_merchant', 'year', 'week', 'merchant_id', unique=True),
+    )
 
     @property
     def amount(self):
-        """ SQLite3 does not work with decimal, the built-in representation suitable for currency
+        """ SQLite3 does not work with decimal, amounts are stored as integer cents.
         Can be extracted as a type following the 3 times rule. """
-        return decimal.Decimal(self._amount)
+        return fees.from_cents(self.amount_cents)
 
     @amount.setter
     def amount(self, amount: decimal.Decimal):
-        self._amount = str(amount)
-
-    def save(self, year, week, merchant):
-        self.merchant_id = merchant.id
-        self.week = week
-        self.year = year
-        # self.amount = self.calculate_amount(merchant_id=self.merchant_id, week=self.week, year=self.year)
+        self.amount_cents = fees.to_cents(amount)
 
-        db.session.add(self)
-        db.session.commit()
+    @staticmethod
+    def disburse(merchant_id, week, year):
+        """ Calculates and writes the disbursement of a merchant, returns its id. Safe to retry or run concurrently """
+        amount = Disbursement.current_amount(merchant_id=merchant_id, week=week, year=year)
+        return Disbursement.bulk_upsert(week=week, year=year, amounts={merchant_id: amount})[merchant_id]
 
     def asdict(self):
         return {'amount': float(self.amount), 'week': self.week, 'year': self.year, 'merchant': self.merchant.name}
 
     @staticmethod
+    def current_amount(merchant_id, week, year):
+        if settings.INCREMENTAL_DISBURSEMENTS:
+            return DisbursementAccumulator.amount(merchant_id=merchant_id, week=week, year=year)
+        return Disbursement.calculate_amount(merchant_id=merchant_id, week=week, year=year)
+
+    @staticmethod
+    @timed('calculate_amount')
     def calculate_amount(merchant_id, week, year):
         orders = Order.amounts_by_merchant_in_week(merchant_id=merchant_id, week=week, year=year)
-        disbursed_amount = decimal.Decimal(0.00)
-        for order in orders:
-            amount = decimal.Decimal(order)
-            if order < 50:
-                disbursed_amount = disbursed_amount + amount + (amount * decimal.Decimal(0.01))
-            elif 50 <= order < 300:
-                disbursed_amount = disbursed_amount + amount + (amount * decimal.Decimal(0.0095))
-            else:
-                disbursed_amount = disbursed_amount + amount + (amount * decimal.Decimal(0.0085))
+        return Disbursement.disbursed_amount(orders)
+
+    @staticmethod
+    @timed('disbursed_amount')
+    def disbursed_amount(orders):
+        """ Disbursed amount of the order amounts in cents """
+        return fees.from_cents(fees.disbursed_cents(orders))
+
+    @staticmethod
+    def bulk_upsert(week, year, amounts):
+        """ Writes the amounts -merchant id to amount- of a week in a single INSERT ... ON CONFLICT DO UPDATE statement
+        and transaction, with the monthly and yearly rollups of the merchants, returns the disbursement id of every
+        merchant. Core statements are used so the after_insert listener is not fired once per row. """
+        if amounts:
+            connection = db.session.connection()
+            ordered = Disbursement.ordered_cents_in_week(connection, week=week, year=year, merchant_ids=amounts)
+            db.session.execute(Upsert(Disbursement.__table__, index_elements=('year', 'week', 'merchant_id'),
+                                      update_columns=('amount_cents', 'fee_cents')),
+                               [{'merchant_id': merchant_id, 'week': week, 'year': year,
+                                 'amount_cents': fees.to_cents(amount),
+                                 'fee_cents': fees.to_cents(amount) - ordered.get(merchant_id, 0)}
+                                for merchant_id, amount in amounts.items()])
+            refresh_rollups(connection, week=week, year=year, merchant_ids=list(amounts))
+            TableVersion.bump(connection, Disbursement.__tablename__)
+        ids = Disbursement.ids_in_week(week=week, year=year, merchant_ids=amounts)
+        db.session.commit()
+        for merchant_id in amounts:
+            invalidate_cached_disbursement(merchant_id=merchant_id, week=week, year=year)
+        return ids
+
+    @staticmethod
+    def ordered_cents_in_week(connection, week, year, merchant_ids):
+        """ Completed order amount in cents per merchant id, the fees are the disbursed amount minus it. Read from the
+        accumulators when disbursements are incremental, so writing them does not scan the orders again """
+        if settings.INCREMENTAL_DISBURSEMENTS:
+            return DisbursementAccumulator.ordered_cents_in_week(connection, week=week, year=year,
+                                                                 merchant_ids=merchant_ids)
+        return Order.total_cents_in_week(connection, week=week, year=year, merchant_ids=merchant_ids)
+
+    @staticmethod
+    def ids_in_week(week, year, merchant_ids):
+        """ Disbursement id per merchant id """
+        return dict(db.session.query(Disbursement.merchant_id, Disbursement.id).filter(
+            Disbursement.week == week,
+            Disbursement.year == year,
+            Disbursement.merchant_id.in_(merchant_ids)).all())
+
+
+def invalidate_cached_disbursement(merchant_id, week, year):
+    disbursement_cache.invalidate((merchant_id, year, week), (None, year, week))
+
+
+def _invalidate_on_commit(connection, target):
+    """ Keeps the disbursement written in a flush to invalidate it once committed, a reader between the flush and the
+    commit would cache the previous amount again. Other processes see the table version bumped """
+    TableVersion.bump(connection, Disbursement.__tablename__)
+    object_session(target).info.setdefault(_WRITTEN_DISBURSEMENTS, set()).add(
+        (target.merchant_id, target.week, target.year))
+
+
+@db.event.listens_for(Session, "after_commit")
+def invalidate_committed_disbursements(session):
+    for merchant_id, week, year in session.info.pop(_WRITTEN_DISBURSEMENTS, ()):
+        invalidate_cached_disbursement(merchant_id=merchant_id, week=week, year=year)
 
-        return decimal.Decimal(disbursed_amount.quantize(decimal.Decimal('.01'), rounding=decimal.ROUND_HALF_UP))
+
+@db.event.listens_for(Session, "after_soft_rollback")
+def discard_written_disbursements(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop(_WRITTEN_DISBURSEMENTS, None)
 
 
 @db.event.listens_for(Disbursement, "after_insert")
+@timed('disbursement_after_insert')
 def add_content_to_inventory_contents(mapper, connection, target):
-    amount = Disbursement.calculate_amount(merchant_id=target.merchant_id, week=target.week, year=target.year)
+    amount_cents = fees.to_cents(
+        Disbursement.current_amount(merchant_id=target.merchant_id, week=target.week, year=target.year))
+    _write_amount(connection, target, amount_cents)
+    refresh_rollups(connection, week=target.week, year=target.year, merchant_ids=[target.merchant_id])
+    _invalidate_on_commit(connection, target)
+
+
+@db.event.listens_for(Disbursement, "after_update")
+def update_disbursement(mapper, connection, target):
+    if get_history(target, 'amount_cents').has_changes():
+        _write_amount(connection, target, target.amount_cents)
+    refresh_rollups(connection, week=target.week, year=target.year, merchant_ids=[target.merchant_id])
+    _invalidate_on_commit(connection, target)
+
+
+@db.event.listens_for(Disbursement, "after_delete")
+def invalidate_disbursement(mapper, connection, target):
+    refresh_rollups(connection, week=target.week, year=target.year, merchant_ids=[target.merchant_id])
+    _invalidate_on_commit(connection, target)
+
+
+def _write_amount(connection, target, amount_cents):
+    ordered = Disbursement.ordered_cents_in_week(connection, week=target.week, year=target.year,
+                                                 merchant_ids=[target.merchant_id])
     table = Disbursement.__table__
     stm = table.update(). \
         where(table.c.merchant_id == target.merchant_id). \
         where(table.c.week == target.week). \
         where(table.c.year == target.year). \
-        values(amount=str(amount))
+        values(amount_cents=amount_cents, fee_cents=amount_cents - ordered.get(target.merchant_id, 0))
     connection.execute(stm)
 
 
+class DisbursementAccumulator(db.Model):
+    """ Running disbursed amount of a merchant in a week, kept up to date as orders complete.
+    The amount is stored unrounded in 1/RATE_SCALE cents so rounding the accumulated total matches a full recompute,
+    next to the order amounts in cents the fees are calculated from """
+    merchant_id = db.Column(db.Integer, db.ForeignKey('merchant.id'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    week = db.Column(db.Integer, primary_key=True)
+    scaled_amount = db.Column(db.BigInteger, nullable=False, default=0)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    amount_cents = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @staticmethod
+    def add(connection, merchant_id, year, week, scaled_amount, orders, amount_cents):
+        DisbursementAccumulator.add_many(connection, [{'merchant_id': merchant_id, 'year': year, 'week': week,
+                                                       'scaled_amount': scaled_amount, 'orders': orders,
+                                                       'amount_cents': amount_cents}])
+
+    @staticmethod
+    def add_many(connection, rows):
+        """ Adds to the accumulators of the rows, created when missing, in a single statement safe to run
+        concurrently """
+        if rows:
+            connection.execute(Upsert(DisbursementAccumulator.__table__, index_elements=('merchant_id', 'year', 'week'),
+                                      increment_columns=('scaled_amount', 'orders', 'amount_cents')), rows)
+
+    @staticmethod
+    def add_orders(connection, orders):
+        """ Adds completed orders -(merchant id, year, week, amount in cents)- written without the ORM events,
+        with one executemany statement """
+        scaled_amounts = fees.scaled_disbursed([cents for _, _, _, cents in orders]).tolist()
+        totals = {}
+        for (merchant_id, year, week, cents), scaled_amount in zip(orders, scaled_amounts):
+            total, count, amount_cents = totals.get((merchant_id, year, week), (0, 0, 0))
+            totals[(merchant_id, year, week)] = (total + scaled_amount, count + 1, amount_cents + cents)
+        DisbursementAccumulator.add_many(connection, [
+            {'merchant_id': merchant_id, 'year': year, 'week': week, 'scaled_amount': scaled_amount, 'orders': count,
+             'amount_cents': amount_cents}
+            for (merchant_id, year, week), (scaled_amount, count, amount_cents) in totals.items()])
+
+    @staticmethod
+    @timed('accumulated_amount')
+    def amount(merchant_id, week, year):
+        scaled_amount = db.session.query(DisbursementAccumulator.scaled_amount).filter(
+            DisbursementAccumulator.merchant_id == merchant_id,
+            DisbursementAccumulator.year == year,
+            DisbursementAccumulator.week == week).scalar()
+        return fees.from_cents(fees.round_half_up(scaled_amount or 0))
+
+    @staticmethod
+    def amounts_in_week(week, year, merchant_ids=None):
+        """ Disbursed cents per merchant id, of every merchant or of merchant_ids """
+        result = db.session.query(DisbursementAccumulator.merchant_id, DisbursementAccumulator.scaled_amount).filter(
+            DisbursementAccumulator.year == year,
+            DisbursementAccumulator.week == week)
+        if merchant_ids is not None:
+            result = result.filter(merchant_filter(DisbursementAccumulator.merchant_id, merchant_ids))
+        return {merchant_id: int(fees.round_half_up(scaled_amount)) for merchant_id, scaled_amount in result}
+
+    @staticmethod
+    def ordered_cents_in_week(connection, week, year, merchant_ids):
+        """ Completed order amount in cents per merchant id """
+        table = DisbursementAccumulator.__table__
+        return dict(connection.execute(select([table.c.merchant_id, table.c.amount_cents]).where(
+            table.c.year == year).where(table.c.week == week).where(
+            merchant_filter(table.c.merchant_id, merchant_ids))).fetchall())
+
+    @staticmethod
+    def recomputed():
+        """ Full recompute from the completed orders, rows of merchant_id, year, week, scaled_amount, orders,
+        amount_cents """
+        return db.session.query(
+            Order.merchant_id, Order.completed_year, Order.completed_week,
+            func.sum(fees.scaled_disbursed_expression(Order.amount_cents)), func.count(Order.id),
+            func.sum(Order.amount_cents)).filter(
+            Order.completed_year.isnot(None)).group_by(
+            Order.merchant_id, Order.completed_year, Order.completed_week)
+
+    @staticmethod
+    def rebuild():
+        """ Replaces every accumulator with a full recompute, used after bulk loads that skip the ORM events """
+        DisbursementAccumulator.replace_all(db.session.connection())
+        db.session.commit()
+
+    @staticmethod
+    def replace_all(connection):
+        table = DisbursementAccumulator.__table__
+        connection.execute(table.delete())
+        connection.execute(table.insert().from_select(
+            ['merchant_id', 'year', 'week', 'scaled_amount', 'orders', 'amount_cents'],
+            DisbursementAccumulator.recomputed()))
+
+    @staticmethod
+    def reconcile():
+        """ Differences between the accumulators and a full recompute, (merchant_id, year, week) to the accumulated
+        and the recomputed (scaled_amount, orders, amount_cents), the fees are calculated from the amount in cents """
+        accumulated = {(row.merchant_id, row.year, row.week): (row.scaled_amount, row.orders, row.amount_cents)
+                       for row in DisbursementAccumulator.query}
+        recomputed = {(merchant_id, year, week): (scaled_amount, orders, amount_cents)
+                      for merchant_id, year, week, scaled_amount, orders, amount_cents
+                      in DisbursementAccumulator.recomputed()}
+        return {key: (accumulated.get(key, _NOTHING_ACCUMULATED), recomputed.get(key, _NOTHING_ACCUMULATED))
+                for key in accumulated.keys() | recomputed.keys()
+                if accumulated.get(key, _NOTHING_ACCUMULATED) != recomputed.get(key, _NOTHING_ACCUMULATED)}
+
+
+class DisbursementMonth(db.Model):
+    """ Rollup of the disbursements of a merchant in a calendar month, the weeks of month_of_week """
+    merchant_id = db.Column(db.Integer, db.ForeignKey('merchant.id'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)
+    amount_cents = db.Column(db.BigInteger, nullable=False, default=0)
+    fee_cents = db.Column(db.BigInteger, nullable=False, default=0)
+    disbursements = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def refresh(connection, year, month, merchant_ids):
+        """ Sums the disbursements of the weeks of the month again, a handful of rows per merchant """
+        disbursement = Disbursement.__table__
+        totals = select([disbursement.c.merchant_id, func.sum(disbursement.c.amount_cents),
+                         func.sum(disbursement.c.fee_cents), func.count()]).where(
+            disbursement.c.year == year).where(disbursement.c.week.in_(weeks_of_month(year, month))).where(
+            disbursement.c.merchant_id.in_(merchant_ids)).group_by(disbursement.c.merchant_id)
+        rows = [{'merchant_id': merchant_id, 'year': year, 'month': month, 'amount_cents': amount_cents,
+                 'fee_cents': fee_cents or 0, 'disbursements': count}
+                for merchant_id, amount_cents, fee_cents, count in connection.execute(totals)]
+        _write_rollup(connection, DisbursementMonth.__table__, ('merchant_id', 'year', 'month'), rows,
+                      (DisbursementMonth.year == year) & (DisbursementMonth.month == month), merchant_ids)
+
+
+class DisbursementYear(db.Model):
+    """ Rollup of the disbursements of a merchant in an ISO year, the sum of its months """
+    merchant_id = db.Column(db.Integer, db.ForeignKey('merchant.id'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    amount_cents = db.Column(db.BigInteger, nullable=False, default=0)
+    fee_cents = db.Column(db.BigInteger, nullable=False, default=0)
+    disbursements = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def refresh(connection, year, merchant_ids):
+        month = DisbursementMonth.__table__
+        totals = select([month.c.merchant_id, func.sum(month.c.amount_cents), func.sum(month.c.fee_cents),
+                         func.sum(month.c.disbursements)]).where(month.c.year == year).where(
+            month.c.merchant_id.in_(merchant_ids)).group_by(month.c.merchant_id)
+        rows = [{'merchant_id': merchant_id, 'year': year, 'amount_cents': amount_cents, 'fee_cents': fee_cents,
+                 'disbursements': count}
+                for merchant_id, amount_cents, fee_cents, count in connection.execute(totals)]
+        _write_rollup(connection, DisbursementYear.__table__, ('merchant_id', 'year'), rows,
+                      DisbursementYear.year == year, merchant_ids)
+
+
+def _write_rollup(connection, table, key, rows, period, merchant_ids):
+    """ Upserts the rows of a period and deletes the ones of the merchants left without disbursements in it """
+    if rows:
+        connection.execute(Upsert(table, index_elements=key,
+                                  update_columns=('amount_cents', 'fee_cents', 'disbursements')), rows)
+    emptied = set(merchant_ids) - {row['merchant_id'] for row in rows}
+    if emptied:
+        connection.execute(table.delete().where(period).where(table.c.merchant_id.in_(emptied)))
+
+
+def rollup_lock(merchant_ids):
+    """ Locks the rollups of the merchants until the transaction ends, in merchant id order so concurrent
+    transactions do not deadlock """
+    merchant = Merchant.__table__
+    ids = select([merchant.c.id]).where(merchant.c.id.in_(merchant_ids)).order_by(merchant.c.id).alias('ids')
+    return select([func.pg_advisory_xact_lock(_ROLLUP_LOCK_CLASS, ids.c.id)])
+
+
+def refresh_rollups(connection, week, year, merchant_ids):
+    """ Brings the monthly and yearly rollups of the merchants up to date with their disbursements of a week. The
+    totals are summed again and written, so transactions writing other weeks of the same merchants are serialized:
+    the one waiting sums the weeks committed by the other. SQLite already serializes the transactions that write """
+    if connection.dialect.name == 'postgresql':
+        connection.execute(rollup_lock(merchant_ids))
+    DisbursementMonth.refresh(connection, year=year, month=month_of_week(year, week), merchant_ids=merchant_ids)
+    DisbursementYear.refresh(connection, year=year, merchant_ids=merchant_ids)
+
+
+def rebuild_rollups(connection):
+    """ Replaces every rollup with the sums of every disbursement """
+    months = {}
+    disbursement = Disbursement.__table__
+    for merchant_id, year, week, amount_cents, fee_cents in connection.execute(select([
+            disbursement.c.merchant_id, disbursement.c.year, disbursement.c.week, disbursement.c.amount_cents,
+            disbursement.c.fee_cents])):
+        key = (merchant_id, year, month_of_week(year, week))
+        total_amount, total_fee, count = months.get(key, (0, 0, 0))
+        months[key] = (total_amount + (amount_cents or 0), total_fee + (fee_cents or 0), count + 1)
+
+    month_table, year_table = DisbursementMonth.__table__, DisbursementYear.__table__
+    connection.execute(year_table.delete())
+    connection.execute(month_table.delete())
+    if months:
+        connection.execute(month_table.insert(), [
+            {'merchant_id': merchant_id, 'year': year, 'month': month, 'amount_cents': amount_cents,
+             'fee_cents': fee_cents, 'disbursements': count}
+            for (merchant_id, year, month), (amount_cents, fee_cents, count) in months.items()])
+    connection.execute(year_table.insert().from_select(
+        ['merchant_id', 'year', 'amount_cents', 'fee_cents', 'disbursements'],
+        select([month_table.c.merchant_id, month_table.c.year, func.sum(month_table.c.amount_cents),
+                func.sum(month_table.c.fee_cents), func.sum(month_table.c.disbursements)]).group_by(
+            month_table.c.merchant_id, month_table.c.year)))
+
+
+class BackfillWeek(db.Model):
+    """ Checkpoint of a week whose disbursements were written by a backfill, so an interrupted one can resume """
+    year = db.Column(db.Integer, primary_key=True)
+    week = db.Column(db.Integer, primary_key=True)
+    merchants = db.Column(db.Integer, nullable=False)
+    orders = db.Column(db.Integer, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    @staticmethod
+    def done(weeks):
+        """ The (year, week) of weeks already backfilled """
+        years = {year for year, _ in weeks}
+        result = db.session.query(BackfillWeek.year, BackfillWeek.week).filter(BackfillWeek.year.in_(years))
+        return set(result) & set(weeks)
+
+    @staticmethod
+    def checkpoint(connection, year, week, merchants, orders):
+        """ Records the week as backfilled, replacing the checkpoint of a backfill overlapping this one """
+        connection.execute(Upsert(BackfillWeek.__table__, index_elements=('year', 'week'),
+                                  update_columns=('merchants', 'orders', 'finished_at')),
+                           {'year': year, 'week': week, 'merchants': merchants, 'orders': orders,
+                            'finished_at': datetime.datetime.utcnow()})
+
+
+class ScheduledShard(db.Model):
+    """ Checkpoint of a shard -merchants with ids from first to last merchant id- disbursed by a scheduled run of a
+    week, so a crashed run only computes the shards left. Shards are fixed ranges of ids, so merchants added or
+    removed only change the shards of their ids """
+    year = db.Column(db.Integer, primary_key=True)
+    week = db.Column(db.Integer, primary_key=True)
+    first_merchant_id = db.Column(db.Integer, primary_key=True)
+    last_merchant_id = db.Column(db.Integer, nullable=False)
+    merchants = db.Column(db.Integer, nullable=False)
+    seconds = db.Column(db.Float, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    @staticmethod
+    def done(year, week):
+        """ The number of merchants disbursed by first merchant id of the shards of a week already disbursed """
+        return dict(db.session.query(ScheduledShard.first_merchant_id, ScheduledShard.merchants).filter(
+            ScheduledShard.year == year,
+            ScheduledShard.week == week))
+
+    @staticmethod
+    def checkpoint(connection, year, week, first_merchant_id, last_merchant_id, merchants, seconds):
+        """ Records the shard as disbursed, replacing the checkpoint of a previous run of the week """
+        connection.execute(Upsert(ScheduledShard.__table__, index_elements=('year', 'week', 'first_merchant_id'),
+                                  update_columns=('last_merchant_id', 'merchants', 'seconds', 'finished_at')),
+                           {'year': year, 'week': week, 'first_merchant_id': first_merchant_id,
+                            'last_merchant_id': last_merchant_id, 'merchants': merchants, 'seconds': seconds,
+                            'finished_at': datetime.datetime.utcnow()})
+
+
+class Job(db.Model):
+    """ Disbursement calculation requested through the API and run by the job queue workers """
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(10), nullable=False, default=PENDING, index=True)
+    week = db.Column(db.Integer, nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    merchant_id = db.Column(db.Integer, db.ForeignKey('merchant.id'), nullable=False)
+    disbursement_id = db.Column(db.Integer, db.ForeignKey('disbursement.id'), nullable=True)
+    error = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    # Worker running the job and when it claimed it
+    owner = db.Column(db.String(64), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+
+    def asdict(self):
+        return {'id': self.id, 'status': self.status, 'week': self.week, 'year': self.year,
+                'merchant_id': self.merchant_id, 'disbursement_id': self.disbursement_id, 'error': self.error}
+
+
 class Merchant(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     cif = db.Column(db.String(10))  # TODO validation
@@ -81,34 +504,93 @@ class Merchant(db.Model):
     name = db.Column(db.String(50), index=True)
 
 
+class TableVersion(db.Model):
+    """ Counter incremented on every write of a table, in-process copies of the table compare it to know when
+    another worker changed it """
+    table_name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def bump(connection, table_name):
+        connection.execute(Upsert(TableVersion.__table__, index_elements=('table_name',),
+                                  increment_columns=('version',)), {'table_name': table_name, 'version': 1})
+
+    @staticmethod
+    def current(table_name, connection=None):
+        table = TableVersion.__table__
+        statement = select([table.c.version]).where(table.c.table_name == table_name)
+        return ((connection or db.session).execute(statement).scalar()) or 0
+
+
+@db.event.listens_for(Merchant, "after_insert")
+@db.event.listens_for(Merchant, "after_update")
+@db.event.listens_for(Merchant, "after_delete")
+def invalidate_merchant_directory(mapper, connection, target):
+    TableVersion.bump(connection, Merchant.__tablename__)
+    merchant_directory.invalidate()
+
+
 class Order(db.Model):
+    # active_history keeps the previous values of what a disbursement accumulator depends on
     id = db.Column(db.Integer, primary_key=True)
-    merchant_id = db.Column(db.Integer, db.ForeignKey('merchant.id'), nullable=False)
+    merchant_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('merchant.id'), nullable=False), active_history=True)
     shopper_id = db.Column(db.Integer, db.ForeignKey('shopper.id'), nullable=False)
-    _amount = db.Column("amount", db.String(50))
+    amount_cents = db.column_property(db.Column(db.Integer), active_history=True)
     created_at = db.Column(db.DateTime, nullable=False)
-    completed_at = db.Column(db.DateTime, nullable=True)
+    completed_at = db.Column(db.DateTime, nullable=True, index=True)
+    completed_year = db.column_property(db.Column(db.Integer, nullable=True), active_history=True)
+    completed_week = db.column_property(db.Column(db.Integer, nullable=True), active_history=True)
+
+    __table_args__ = (
+        db.Index('ix_order_completed_year_week_merchant', 'completed_year', 'completed_week', 'merchant_id'),
+    )
 
     @property
     def amount(self):
-        """ SQLite3 does not work with decimal, the built-in representation suitable for currency
+        """ SQLite3 does not work with decimal, amounts are stored as integer cents.
         Can be extracted as a type following the 3 times rule. """
-        return decimal.Decimal(self._amount)
+        return fees.from_cents(self.amount_cents)
 
     @amount.setter
     def amount(self, amount: decimal.Decimal):
-        self._amount = str(amount)
+        self.amount_cents = fees.to_cents(amount)
+
+    @validates('completed_at')
+    def validate_completed_at(self, key, completed_at):
+        """ ISO year and week are precomputed so week lookups use the index instead of extract() scans """
+        self.completed_year, self.completed_week = iso_year_week(completed_at)
+        return completed_at
 
     @classmethod
+    @timed('amounts_by_merchant_in_week')
     def amounts_by_merchant_in_week(cls, merchant_id, week, year):
-        # extract() it is slow because it uses full table scans,
-        # alternative use https://docs.sqlalchemy.org/en/13/orm/composites.html or add columns -week,year- with indexes
-        result = Order.query.join(Merchant, Merchant.id == Order.merchant_id).filter(
-            Order.completed_at is not None,
-            extract('year', Order.completed_at) == year,
-            extract('week', Order.completed_at) == week - 1,
-            merchant_id == Merchant.id).all()
-        return [order.amount for order in result]
+        """ Amounts in cents """
+        result = db.session.query(Order.amount_cents).filter(
+            Order.completed_year == year,
+            Order.completed_week == week,
+            Order.merchant_id == merchant_id)
+        return [amount_cents for amount_cents, in result]
+
+    @staticmethod
+    def total_cents_in_week(connection, week, year, merchant_ids):
+        """ Completed order amount in cents per merchant id """
+        table = Order.__table__
+        return dict(connection.execute(select([table.c.merchant_id, func.sum(table.c.amount_cents)]).where(
+            table.c.completed_year == year).where(table.c.completed_week == week).where(
+            merchant_filter(table.c.merchant_id, merchant_ids)).group_by(table.c.merchant_id)).fetchall())
+
+    @classmethod
+    def amounts_in_week(cls, week, year, merchant_ids=None):
+        """ Merchant ids and amounts in cents of the given week, of every merchant or of merchant_ids, sorted by
+        merchant, read in a single index scan """
+        result = db.session.query(Order.merchant_id, Order.amount_cents).filter(
+            Order.completed_year == year,
+            Order.completed_week == week)
+        if merchant_ids is not None:
+            result = result.filter(merchant_filter(Order.merchant_id, merchant_ids))
+        result = result.order_by(Order.merchant_id).all()
+        return np.array(result, dtype=np.int64).reshape(-1, 2).T
 
 
 class Shopper(db.Model):
@@ -116,3 +598,45 @@ class Shopper(db.Model):
     email = db.Column(db.String(50))
     name = db.Column(db.String(50))
     nif = db.Column(db.String(50))  # TODO validation
+
+
+def _order_contribution(order, previous=False):
+    """ Accumulator key, scaled amount and amount in cents of an order, None when it is not completed.
+    previous=True returns the contribution before the changes being flushed """
+    def value(key):
+        if previous:
+            history = get_history(order, key)
+            if history.deleted:
+                return history.deleted[0]
+        return getattr(order, key)
+
+    if value('completed_year') is None:
+        return None
+    key = (value('merchant_id'), value('completed_year'), value('completed_week'))
+    return key, int(fees.scaled_disbursed(value('amount_cents'))), value('amount_cents')
+
+
+def _accumulate(connection, contribution, sign):
+    if contribution is not None:
+        (merchant_id, year, week), scaled_amount, amount_cents = contribution
+        DisbursementAccumulator.add(connection, merchant_id=merchant_id, year=year, week=week,
+                                    scaled_amount=sign * scaled_amount, orders=sign, amount_cents=sign * amount_cents)
+
+
+@db.event.listens_for(Order, "after_insert")
+def accumulate_completed_order(mapper, connection, target):
+    _accumulate(connection, _order_contribution(target), 1)
+
+
+@db.event.listens_for(Order, "after_update")
+def accumulate_order_changes(mapper, connection, target):
+    """ Completing, reverting or modifying an order moves its contribution between accumulators """
+    previous, current = _order_contribution(target, previous=True), _order_contribution(target)
+    if previous != current:
+        _accumulate(connection, previous, -1)
+        _accumulate(connection, current, 1)
+
+
+@db.event.listens_for(Order, "after_delete")
+def reverse_deleted_order(mapper, connection, target):
+    _accumulate(connection, _order_contribution(target, previous=True), -1)
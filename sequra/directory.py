@@ -0,0 +1,90 @@
+"""
+    Directory
+    =========
+
+    In-process copy of the merchant names and ids, so resolving the merchant of a request is a dict lookup.
+    It is reloaded after the merchants are written by this process, and when the merchant table version in the
+    database -incremented by every worker writing merchants- changed, checked at most every
+    settings.MERCHANT_DIRECTORY_CHECK_INTERVAL seconds.
+"""
+import threading
+import time
+
+from sequra import settings
+from sequra.database import db
+from sequra.metrics import CallbackMetric, registry
+
+
+class MerchantDirectory:
+
+    def __init__(self, check_interval, clock=time.monotonic):
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._ids = {}
+        self._names = {}
+        self._version = None
+        self._checked_at = None
+        self._lock = threading.RLock()
+
+    def load(self):
+        from sequra.database.models import Merchant, TableVersion
+        with self._lock:
+            version = TableVersion.current(Merchant.__tablename__)
+            self._names = dict(db.session.query(Merchant.id, Merchant.name))
+            self._ids = {name: merchant_id for merchant_id, name in self._names.items()}
+            self._version = version
+            self._checked_at = self._clock()
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+    def id_of(self, name):
+        """ Merchant id of a name, None when there is no such merchant.
+        Names not in the directory are looked up in the database, they may have been added by another worker """
+        from sequra.database.models import Merchant
+        with self._lock:
+            self._refresh()
+            merchant_id = self._ids.get(name)
+            if merchant_id is not None:
+                self.hits += 1
+                return merchant_id
+            self.misses += 1
+        merchant_id = Merchant.query.with_entities(Merchant.id).filter(Merchant.name == name).scalar()
+        if merchant_id is not None:
+            with self._lock:
+                self._ids[name] = merchant_id
+                self._names[merchant_id] = name
+        return merchant_id
+
+    def merchants(self):
+        """ Name per merchant id of every merchant """
+        with self._lock:
+            self._refresh()
+            return dict(self._names)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self._ids), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def _refresh(self):
+        from sequra.database.models import Merchant, TableVersion
+        if self._version is None:
+            self.load()
+        elif self._clock() - self._checked_at >= self.check_interval:
+            self._checked_at = self._clock()
+            if TableVersion.current(Merchant.__tablename__) != self._version:
+                self.load()
+
+
+merchant_directory = MerchantDirectory(check_interval=settings.MERCHANT_DIRECTORY_CHECK_INTERVAL)
+registry.register(CallbackMetric('sequra_merchant_directory_size', 'Merchants in the in-process directory.', 'gauge',
+                                 lambda: merchant_directory.stats()['size']))
+registry.register(CallbackMetric('sequra_merchant_directory_hits_total', 'Merchant names resolved by the directory.',
+                                 'counter', lambda: merchant_directory.hits))
+registry.register(CallbackMetric('sequra_merchant_directory_misses_total',
+                                 'Merchant names looked up in the database.', 'counter',
+                                 lambda: merchant_directory.misses))
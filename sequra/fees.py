@@ -0,0 +1,67 @@
+"""
+    Fees
+    ====
+
+    Disbursement fee rules applied to money as integer minor units (cents).
+
+    Fee rates are integers over RATE_SCALE, so the disbursed amount of an order, amount * (RATE_SCALE + rate),
+    is an exact integer in 1/RATE_SCALE cents. Totals are rounded once to cents with ROUND_HALF_UP.
+"""
+import decimal
+
+import numpy as np
+
+CENTS = decimal.Decimal('.01')
+RATE_SCALE = 10000
+
+# (upper bound in cents exclusive, fee rate over RATE_SCALE): 1% below 50 €, 0.95% below 300 €, 0.85% otherwise
+FEE_TIERS = ((5000, 100), (30000, 95))
+LAST_TIER_RATE = 85
+
+
+def to_cents(amount) -> int:
+    return int(decimal.Decimal(amount).quantize(CENTS, rounding=decimal.ROUND_HALF_UP).scaleb(2))
+
+
+def from_cents(cents) -> decimal.Decimal:
+    return decimal.Decimal(int(cents)).scaleb(-2)
+
+
+def fee_rates(cents):
+    """ Fee rate of every amount, a reversal -negative amount- has the rate of the order it reverses """
+    absolute = np.abs(cents)
+    return np.select([absolute < bound for bound, _ in FEE_TIERS], [rate for _, rate in FEE_TIERS], LAST_TIER_RATE)
+
+
+def scaled_disbursed(cents):
+    """ Disbursed amount -amount plus fee- of every amount in 1/RATE_SCALE cents """
+    cents = np.asarray(cents, dtype=np.int64)
+    return cents * (RATE_SCALE + fee_rates(cents))
+
+
+def round_half_up(scaled):
+    """ Rounds amounts in 1/RATE_SCALE cents to cents, halves away from zero as decimal.ROUND_HALF_UP """
+    return np.sign(scaled) * ((np.abs(scaled) + RATE_SCALE // 2) // RATE_SCALE)
+
+
+def disbursed_cents(cents) -> int:
+    return int(round_half_up(scaled_disbursed(cents).sum()))
+
+
+def disbursed_cents_by_merchant(merchant_ids, cents) -> dict:
+    """ Disbursed cents per merchant, amounts must be sorted by merchant id """
+    merchant_ids = np.asarray(merchant_ids, dtype=np.int64)
+    if not merchant_ids.size:
+        return {}
+    starts = np.flatnonzero(np.concatenate(([True], merchant_ids[1:] != merchant_ids[:-1])))
+    totals = round_half_up(np.add.reduceat(scaled_disbursed(cents), starts))
+    return dict(zip(merchant_ids[starts].tolist(), totals.tolist()))
+
+
+def scaled_disbursed_expression(amount_cents):
+    """ SQL expression of scaled_disbursed, aggregates in the database with the same exact integer arithmetic """
+    # Imported here so the fee rules are usable without SQLAlchemy, as the snapshot calculator does
+    from sqlalchemy import case, func
+    absolute = func.abs(amount_cents)
+    rate = case([(absolute < bound, rate) for bound, rate in FEE_TIERS], else_=LAST_TIER_RATE)
+    return amount_cents * (RATE_SCALE + rate)
@@ -0,0 +1,195 @@
+"""
+    Ingestion
+    =========
+
+    Buffer of the order events received by POST /orders. Events are written in micro-batches, when
+    settings.INGEST_BATCH_SIZE events are waiting or the oldest one waited settings.INGEST_FLUSH_INTERVAL seconds,
+    by the job queue workers.
+
+    A batch is written with a few executemany Core statements in one transaction, instead of an ORM flush per order,
+    so the disbursement accumulators are updated here with one statement per merchant and week.
+    Events still buffered when the process stops are lost, producers should retry the batches not acknowledged:
+    creating an order again is ignored, as completing it again, so retries are idempotent. Events of unknown merchants,
+    shoppers or orders are rejected one by one, and a batch failing is written again event by event, so an event
+    never loses the other events of its batch.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+from sequra import fees, settings
+from sequra.database import Upsert, db
+from sequra.jobs import job_queue
+from sequra.metrics import CallbackMetric, registry
+
+log = logging.getLogger(__name__)
+
+CREATE = 'create'
+COMPLETE = 'complete'
+
+FLUSH_SECONDS = registry.histogram('sequra_ingest_flush_seconds', 'Duration of the order event batch writes.')
+FLUSH_EVENTS = registry.histogram('sequra_ingest_flush_events', 'Order events written per batch.',
+                                  buckets=(1, 10, 100, 500, 1000, 5000, 10000))
+
+
+class IngestBuffer:
+
+    def __init__(self, batch_size, flush_interval, max_queue, clock=time.monotonic):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.failed = 0
+        self.rejected = 0
+        self._clock = clock
+        self._events = deque()
+        self._oldest = None
+        self._flushing = False
+        self._lock = threading.Lock()
+        self._timer = None
+        self._submit = None
+
+    def init_app(self, app):
+        """ Batches are written by the job queue of the application """
+        self._submit = job_queue.submit
+        if self._timer is None:
+            self._timer = threading.Thread(target=self._flush_when_due, name='ingest', daemon=True)
+            self._timer.start()
+
+    @property
+    def depth(self):
+        """ Events waiting to be written """
+        return len(self._events)
+
+    def add(self, events):
+        """ Buffers the events, False when the buffer is full """
+        with self._lock:
+            if len(self._events) + len(events) > self.max_queue:
+                return False
+            if not self._events:
+                self._oldest = self._clock()
+            self._events.extend(events)
+            full = len(self._events) >= self.batch_size
+        if full:
+            self._schedule()
+        return True
+
+    def flush(self):
+        """ Writes the buffered events by batches, returns the number of events written """
+        written = 0
+        while True:
+            with self._lock:
+                batch = [self._events.popleft() for _ in range(min(self.batch_size, len(self._events)))]
+                self._oldest = self._clock() if self._events else None
+            if not batch:
+                break
+            start = time.perf_counter()
+            written += self._write(batch)
+            FLUSH_SECONDS.observe(time.perf_counter() - start)
+            FLUSH_EVENTS.observe(len(batch))
+        with self._lock:
+            self._flushing = False
+        return written
+
+    def _write(self, batch):
+        """ Returns the number of events written, a failing batch is written again one event at a time """
+        try:
+            self.rejected += len(write_events(batch))
+            return len(batch)
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Could not write a batch of %s order events', len(batch))
+            db.session.rollback()
+        if len(batch) == 1:
+            self.failed += 1
+            return 0
+        return sum(self._write([event]) for event in batch)
+
+    def _schedule(self):
+        with self._lock:
+            if self._flushing or self._submit is None:
+                return
+            self._flushing = True
+        self._submit(self.flush)
+
+    def _flush_when_due(self):
+        while True:
+            time.sleep(self.flush_interval / 4)
+            oldest = self._oldest
+            if oldest is not None and self._clock() - oldest >= self.flush_interval:
+                self._schedule()
+
+
+def write_events(events):
+    """ Inserts the created orders, then completes the orders of the complete events, in one transaction.
+    Returns the events rejected, creations of unknown merchants or shoppers and completions of unknown orders """
+    from sequra.database.models import DisbursementAccumulator, Merchant, Order, Shopper, iso_year_week
+    table = Order.__table__
+    connection = db.session.connection()
+
+    creations = {}
+    for event in events:
+        if event['type'] == CREATE:
+            creations.setdefault(event['id'], event)
+    merchant_ids = _existing_ids(connection, Merchant.__table__, {event['merchant_id'] for event in creations.values()})
+    shopper_ids = _existing_ids(connection, Shopper.__table__, {event['shopper_id'] for event in creations.values()})
+    rejected = [event for event in creations.values()
+                if event['merchant_id'] not in merchant_ids or event['shopper_id'] not in shopper_ids]
+    # Orders created again by a retry are left untouched
+    existing = _existing_ids(connection, table, set(creations))
+    created = []
+    for order_id, event in creations.items():
+        if order_id in existing or event['merchant_id'] not in merchant_ids or event['shopper_id'] not in shopper_ids:
+            continue
+        completed_year, completed_week = iso_year_week(event.get('completed_at'))
+        created.append({'id': order_id, 'merchant_id': event['merchant_id'], 'shopper_id': event['shopper_id'],
+                        'amount_cents': fees.to_cents(event['amount']), 'created_at': event['created_at'],
+                        'completed_at': event.get('completed_at'), 'completed_year': completed_year,
+                        'completed_week': completed_week})
+    if created:
+        connection.execute(Upsert(table, index_elements=('id',)), created)
+
+    completions = {event['id']: event for event in events if event['type'] == COMPLETE}
+    known = _existing_ids(connection, table, set(completions))
+    rejected += [event for order_id, event in completions.items() if order_id not in known]
+    # Only the first completion of an order counts, the orders already completed are left untouched
+    pending = connection.execute(db.select([table.c.id, table.c.merchant_id, table.c.amount_cents]).where(
+        table.c.id.in_(completions)).where(table.c.completed_at.is_(None))).fetchall() if completions else []
+    completed = []
+    for order_id, _, _ in pending:
+        completed_at = completions[order_id]['completed_at']
+        completed_year, completed_week = iso_year_week(completed_at)
+        completed.append({'_id': order_id, 'completed_at': completed_at, 'completed_year': completed_year,
+                          'completed_week': completed_week})
+    if completed:
+        connection.execute(table.update().where(table.c.id == db.bindparam('_id')).values(
+            completed_at=db.bindparam('completed_at'), completed_year=db.bindparam('completed_year'),
+            completed_week=db.bindparam('completed_week')), completed)
+
+    DisbursementAccumulator.add_orders(connection, [
+        (row['merchant_id'], row['completed_year'], row['completed_week'], row['amount_cents'])
+        for row in created if row['completed_at'] is not None] + [
+        (merchant_id, row['completed_year'], row['completed_week'], amount_cents)
+        for (_, merchant_id, amount_cents), row in zip(pending, completed)])
+    db.session.commit()
+    if rejected:
+        log.warning('Rejected %s order events of unknown merchants, shoppers or orders: %s', len(rejected),
+                    ', '.join(f'{event["type"]} {event["id"]}' for event in rejected))
+    log.info('Ingested %s created and %s completed orders', len(created), len(completed))
+    return rejected
+
+
+def _existing_ids(connection, table, ids):
+    if not ids:
+        return set()
+    return {row_id for row_id, in connection.execute(db.select([table.c.id]).where(table.c.id.in_(ids)))}
+
+
+ingest_buffer = IngestBuffer(batch_size=settings.INGEST_BATCH_SIZE, flush_interval=settings.INGEST_FLUSH_INTERVAL,
+                             max_queue=settings.INGEST_MAX_QUEUE)
+registry.register(CallbackMetric('sequra_ingest_queue_depth', 'Order events waiting to be written.', 'gauge',
+                                 lambda: ingest_buffer.depth))
+registry.register(CallbackMetric('sequra_ingest_rejected_events_total',
+                                 'Order events of unknown merchants, shoppers or orders.', 'counter',
+                                 lambda: ingest_buffer.rejected))
+registry.register(CallbackMetric('sequra_ingest_failed_events_total', 'Order events whose batch could not be written.',
+                                 'counter', lambda: ingest_buffer.failed))
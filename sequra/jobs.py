@@ -0,0 +1,165 @@
+"""
+    Job queue
+    =========
+
+    Disbursement calculations requested through the API are persisted as Job rows and run outside of the request
+    by a pool of settings.MAX_POOL_WORKERS threads. Threads are used instead of processes so workers share the
+    database engine of the application.
+
+    Every process -as the WSGI workers- resumes the unfinished jobs when it starts. A job is claimed atomically before
+    running, so it runs in a single worker, and a job left running is only claimed again after
+    settings.JOB_CLAIM_TIMEOUT seconds, when its worker is considered gone.
+
+    An in-memory SQLite database is a single connection shared by every thread, in that case jobs, enqueuing and the
+    API reads are serialized since concurrent transactions on one connection would interleave.
+"""
+import contextlib
+import datetime
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from sqlalchemy import and_, or_
+
+from sequra import settings
+from sequra.database import db
+from sequra.metrics import CallbackMetric, registry
+
+log = logging.getLogger(__name__)
+
+
+class JobQueue:
+
+    def __init__(self, app=None, max_workers=settings.MAX_POOL_WORKERS):
+        self.app = None
+        self.max_workers = max_workers
+        self._executor = None
+        self._futures = set()
+        self._lock = contextlib.nullcontext()
+        self._single_connection = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        if is_single_connection(app.config.get('SQLALCHEMY_DATABASE_URI')):
+            self._lock = threading.RLock()
+            self._single_connection = True
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+        return self._executor
+
+    def enqueue(self, merchant_id, week, year):
+        from sequra.database.models import Job
+        job = Job(merchant_id=merchant_id, week=week, year=year)
+        with self._lock:
+            db.session.add(job)
+            db.session.commit()
+            db.session.refresh(job)
+        self._submit(job.id)
+        return job
+
+    def submit(self, function, *args, **kwargs):
+        """ Runs any function in a worker, inside the application context """
+        future = self.executor.submit(self._call, function, *args, **kwargs)
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        return future
+
+    @property
+    def depth(self):
+        """ Jobs submitted and not finished yet """
+        return len(self._futures)
+
+    @property
+    def owner(self):
+        """ Worker claiming the jobs, the process id changes in forked workers """
+        return f'{socket.gethostname()}:{os.getpid()}'[:64]
+
+    def resume(self):
+        """ Submits the jobs pending, or left running by a worker that stopped, they are claimed when run """
+        from sequra.database.models import Job
+        job_ids = [job_id for job_id, in db.session.query(Job.id).filter(claimable(Job.__table__))]
+        db.session.commit()
+        for job_id in job_ids:
+            self._submit(job_id)
+        return len(job_ids)
+
+    @contextlib.contextmanager
+    def read_connection(self):
+        """ Connection of the API reads, returned to the pool as soon as the rows are read. Returning the single
+        connection of an in-memory database rolls it back, with the uncommitted work of a job, so the session is read
+        instead while no job runs """
+        if not self._single_connection:
+            with db.engine.connect() as connection:
+                yield connection
+            return
+        with self._lock:
+            try:
+                yield db.session.connection()
+            finally:
+                db.session.rollback()
+
+    def wait(self, timeout=None):
+        """ Blocks until the submitted jobs are finished """
+        return wait(list(self._futures), timeout=timeout)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _submit(self, job_id):
+        self.submit(self._run, job_id)
+
+    def _call(self, function, *args, **kwargs):
+        with self.app.app_context(), self._lock:
+            return function(*args, **kwargs)
+
+    def claim(self, job_id):
+        """ Marks the job as running by this worker, False when another worker claimed it """
+        from sequra.database.models import Job
+        table = Job.__table__
+        claimed = db.session.execute(table.update().where(table.c.id == job_id).where(claimable(table)).values(
+            status=Job.RUNNING, owner=self.owner, claimed_at=datetime.datetime.utcnow()))
+        db.session.commit()
+        return claimed.rowcount == 1
+
+    def _run(self, job_id):
+        from sequra.database.models import Disbursement, Job
+        if not self.claim(job_id):
+            log.info('Job %s is already claimed', job_id)
+            return
+        job = Job.query.get(job_id)
+        try:
+            job.disbursement_id = Disbursement.disburse(merchant_id=job.merchant_id, week=job.week, year=job.year)
+            job.status = Job.DONE
+        except Exception as error:  # pylint: disable=broad-except
+            log.exception('Job %s failed', job_id)
+            db.session.rollback()
+            job.status = Job.FAILED
+            job.error = str(error)[:255]
+        job.finished_at = datetime.datetime.utcnow()
+        db.session.commit()
+
+
+def claimable(table):
+    """ Condition of the jobs pending, or running with a claim older than settings.JOB_CLAIM_TIMEOUT """
+    from sequra.database.models import Job
+    stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=settings.JOB_CLAIM_TIMEOUT)
+    return or_(table.c.status == Job.PENDING,
+               and_(table.c.status == Job.RUNNING, or_(table.c.claimed_at.is_(None), table.c.claimed_at < stale)))
+
+
+def is_single_connection(database_uri):
+    return database_uri in ('sqlite://', 'sqlite:///:memory:')
+
+
+job_queue = JobQueue()
+registry.register(CallbackMetric('sequra_job_queue_depth', 'Jobs submitted and not finished yet.', 'gauge',
+                                 lambda: job_queue.depth))
@@ -0,0 +1,192 @@
+"""
+    Metrics
+    =======
+
+    In-process instrumentation exposed in the Prometheus text format: latency of every API request, number and
+    duration of the SQL queries of a request -from SQLAlchemy engine events- and timing spans around the
+    disbursement calculations.
+
+    A request sent with the X-Profile header, when settings.PROFILING_ENABLED, is answered with the cProfile
+    summary of its execution instead of its body.
+"""
+import contextlib
+import cProfile
+import functools
+import io
+import pstats
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from sequra import settings
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _labels_text(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            series = self._series.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def count(self, **labels):
+        series = self._series.get(tuple(str(labels[label]) for label in self.labels))
+        return series['count'] if series else 0
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        bucket_labels = self.labels + ('le',)
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets + ('+Inf',), series['buckets'] + [series['count']]):
+                    lines.append(f'{self.name}_bucket{_labels_text(bucket_labels, key + (bound,))} {count}')
+                lines.append(f'{self.name}_sum{_labels_text(self.labels, key)} {series["sum"]}')
+                lines.append(f'{self.name}_count{_labels_text(self.labels, key)} {series["count"]}')
+        return lines
+
+
+class CallbackMetric:
+    """ Counter or gauge whose value is read from the instrumented object when rendered """
+
+    def __init__(self, name, documentation, metric_type, callback):
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self.callback = callback
+
+    def render(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}',
+                f'{self.name} {self.callback()}']
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram('sequra_request_seconds', 'Latency of the API requests.',
+                                     labels=('method', 'endpoint', 'status'))
+SQL_QUERY_SECONDS = registry.histogram('sequra_sql_query_seconds', 'Duration of the SQL queries.',
+                                       labels=('endpoint',))
+SQL_QUERIES_PER_REQUEST = registry.histogram('sequra_sql_queries_per_request', 'SQL queries run by an API request.',
+                                             labels=('endpoint',), buckets=COUNT_BUCKETS)
+SPAN_SECONDS = registry.histogram('sequra_span_seconds', 'Duration of the instrumented calculation steps.',
+                                  labels=('span',))
+
+
+@contextlib.contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SPAN_SECONDS.observe(time.perf_counter() - start, span=name)
+
+
+def timed(name):
+    """ Decorator recording every call of the function as a span """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _endpoint():
+    return (request.endpoint or 'unknown') if has_request_context() else 'background'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _finish_query(conn, cursor, statement, parameters, context, executemany):
+    _observe_query(context)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _fail_query(exception_context):
+    """ A statement raising does not reach after_cursor_execute, it is counted here """
+    _observe_query(exception_context.execution_context)
+
+
+def _observe_query(context):
+    """ The start is kept in the execution context of the statement, it ends with it even when the statement fails """
+    start = getattr(context, 'query_start', None)
+    if start is None:
+        return
+    del context.query_start
+    SQL_QUERY_SECONDS.observe(time.perf_counter() - start, endpoint=_endpoint())
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    g.sql_queries = 0
+    if settings.PROFILING_ENABLED and request.headers.get('X-Profile'):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def _finish_request(response):
+    endpoint = _endpoint()
+    REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, method=request.method, endpoint=endpoint,
+                            status=response.status_code)
+    SQL_QUERIES_PER_REQUEST.observe(g.sql_queries, endpoint=endpoint)
+    response.headers['X-SQL-Queries'] = str(g.sql_queries)
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(settings.PROFILING_ROWS)
+        response.set_data(summary.getvalue())
+        response.mimetype = 'text/plain'
+    return response
+
+
+def init_app(app):
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
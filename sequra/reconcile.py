@@ -0,0 +1,53 @@
+"""
+    Reconciliation
+    ==============
+
+    Checks the disbursement accumulators, updated order by order, against a full recompute from the completed orders:
+    the disbursed amount, the number of orders and their amount the fees are calculated from.
+
+    Usage: python sequra/reconcile.py [--repair]
+"""
+import argparse
+import logging
+import sys
+
+from sequra import fees
+from sequra.database.models import DisbursementAccumulator
+
+log = logging.getLogger(__name__)
+
+
+def reconcile(repair=False):
+    differences = DisbursementAccumulator.reconcile()
+    for (merchant_id, year, week), (accumulated, recomputed) in sorted(differences.items()):
+        log.warning('Merchant %s week %s of %s accumulated %s but recomputed %s', merchant_id, week, year,
+                    _describe(*accumulated), _describe(*recomputed))
+    if differences and repair:
+        DisbursementAccumulator.rebuild()
+        log.info('Rebuilt the accumulators from the completed orders')
+    return differences
+
+
+def _describe(scaled_amount, orders, amount_cents):
+    return (f'{fees.from_cents(fees.round_half_up(scaled_amount))} disbursed of {orders} orders of '
+            f'{fees.from_cents(amount_cents)}')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Check the disbursement accumulators against a full recompute')
+    parser.add_argument('--repair', action='store_true', help='rebuild the accumulators when they differ')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from sequra import app as flask_app
+    args = parse_args(argv)
+    flask_app.create_app(serve_api=False)
+    with flask_app.app.app_context():
+        differences = reconcile(repair=args.repair)
+    log.info('%s accumulators differ from the completed orders', len(differences))
+    return 1 if differences and not args.repair else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
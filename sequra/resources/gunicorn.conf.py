@@ -0,0 +1,13 @@
+"""
+    Gunicorn settings of the serving mode, see sequra/wsgi.py
+"""
+from sequra import settings
+from sequra.jobs import is_single_connection
+
+bind = settings.WEB_BIND
+workers = 1 if is_single_connection(settings.SQLALCHEMY_DATABASE_URI) else settings.WEB_WORKERS
+# Threaded workers so a request waiting on the database does not hold the whole process
+worker_class = 'gthread'
+threads = settings.WEB_THREADS
+# Every worker creates its own engine and connection pool after the fork
+preload_app = False
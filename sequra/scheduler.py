@@ -0,0 +1,130 @@
+"""
+    Scheduler
+    =========
+
+    Disburses every merchant each Monday, at settings.SCHEDULER_HOUR, for the previous ISO week, without an external
+    cron. Merchants are split in shards of fixed ranges of settings.SCHEDULER_SHARD_SIZE ids, computed by a pool of
+    settings.MAX_POOL_WORKERS processes when the database is shared between processes, and every finished shard is
+    checkpointed: a run started again for the same week, after a crash, only computes the shards left and the ones
+    whose merchants changed since.
+
+    Usage: python sequra/scheduler.py [--once] [--year 2018 --week 2] [--processes 4]
+"""
+import argparse
+import datetime
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import func
+
+from sequra import settings
+from sequra.batch import disburse_week
+from sequra.database import db
+from sequra.database.models import Merchant, ScheduledShard
+
+log = logging.getLogger(__name__)
+
+
+def previous_week(today):
+    """ ISO (year, week) of the week before the one of today """
+    return tuple((today - datetime.timedelta(weeks=1)).isocalendar()[:2])
+
+
+def next_run(now):
+    """ Next Monday at SCHEDULER_HOUR after now """
+    monday = datetime.datetime.combine(now.date() - datetime.timedelta(days=now.weekday()),
+                                       datetime.time(settings.SCHEDULER_HOUR))
+    return monday if monday > now else monday + datetime.timedelta(weeks=1)
+
+
+def shards(shard_size=settings.SCHEDULER_SHARD_SIZE):
+    """ (first, last merchant id, merchants) of the ranges of shard_size ids with merchants """
+    index = Merchant.id / shard_size
+    return [(shard * shard_size, (shard + 1) * shard_size - 1, merchants) for shard, merchants in
+            Merchant.query.with_entities(index, func.count()).group_by(index).order_by(index)]
+
+
+def disburse_shard(year, week, first_merchant_id, last_merchant_id):
+    """ Disburses the merchants of a shard and checkpoints it, returns the number of merchants and the seconds taken """
+    start = time.perf_counter()
+    merchant_ids = [merchant_id for merchant_id, in Merchant.query.with_entities(Merchant.id).filter(
+        Merchant.id.between(first_merchant_id, last_merchant_id))]
+    disburse_week(year=year, week=week, merchant_ids=merchant_ids)
+    seconds = time.perf_counter() - start
+    ScheduledShard.checkpoint(db.session.connection(), year=year, week=week, first_merchant_id=first_merchant_id,
+                              last_merchant_id=last_merchant_id, merchants=len(merchant_ids), seconds=seconds)
+    db.session.commit()
+    return len(merchant_ids), seconds
+
+
+def _shard_process(year, week, first_merchant_id, last_merchant_id):
+    from sequra import app as flask_app
+    flask_app.configure_app(flask_app.app)
+    db.init_app(flask_app.app)
+    with flask_app.app.app_context():
+        return disburse_shard(year, week, first_merchant_id, last_merchant_id)
+
+
+def run_week(year, week, processes=settings.MAX_POOL_WORKERS, shard_size=settings.SCHEDULER_SHARD_SIZE):
+    """ Disburses the shards of a week not checkpointed yet, returns the wall time and the throughput of every shard """
+    from sequra.jobs import is_single_connection
+    start = time.perf_counter()
+    done = ScheduledShard.done(year, week)
+    # A shard is disbursed again when merchants were added to or removed from its range since its checkpoint
+    pending = [(first_merchant_id, last_merchant_id) for first_merchant_id, last_merchant_id, merchants
+               in shards(shard_size) if done.get(first_merchant_id) != merchants]
+    log.info('Disbursing week %s of %s, %s shards pending, %s already done', week, year, len(pending), len(done))
+
+    if processes > 1 and len(pending) > 1 and not is_single_connection(settings.SQLALCHEMY_DATABASE_URI):
+        # Processes open their own connections, the session of this one must not hold a transaction meanwhile
+        db.session.commit()
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_shard_process, year, week, *shard) for shard in pending]
+            results = [future.result() for future in futures]
+    else:
+        results = [disburse_shard(year, week, *shard) for shard in pending]
+
+    report = {'year': year, 'week': week, 'seconds': time.perf_counter() - start, 'shards': []}
+    for (first_merchant_id, last_merchant_id), (merchants, seconds) in zip(pending, results):
+        throughput = merchants / seconds if seconds else 0
+        report['shards'].append({'first_merchant_id': first_merchant_id, 'last_merchant_id': last_merchant_id,
+                                 'merchants': merchants, 'seconds': seconds, 'throughput': throughput})
+        log.info('Shard %s-%s: %s merchants in %.3fs, %.0f merchants/s', first_merchant_id, last_merchant_id,
+                 merchants, seconds, throughput)
+    log.info('Disbursed week %s of %s in %.3fs', week, year, report['seconds'])
+    return report
+
+
+def run_forever(processes=settings.MAX_POOL_WORKERS, now=datetime.datetime.now, sleep=time.sleep):
+    """ Disburses the previous week now, in case the last run did not finish, then every Monday """
+    while True:
+        run_week(*previous_week(now().date()), processes=processes)
+        wait = (next_run(now()) - now()).total_seconds()
+        log.info('Next run in %.0f seconds', wait)
+        sleep(max(wait, 0))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Disburse every merchant each Monday for the previous week')
+    parser.add_argument('--once', action='store_true', help='disburse a single week and exit')
+    parser.add_argument('--year', type=int, help='week to disburse with --once, the previous week by default')
+    parser.add_argument('--week', type=int)
+    parser.add_argument('--processes', type=int, default=settings.MAX_POOL_WORKERS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from sequra import app as flask_app
+    args = parse_args(argv)
+    flask_app.create_app(serve_api=False)
+    with flask_app.app.app_context():
+        if args.once:
+            year, week = previous_week(datetime.date.today())
+            run_week(args.year or year, args.week or week, processes=args.processes)
+        else:
+            run_forever(processes=args.processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+    Snapshot
+    ========
+
+    Columnar export of the completed orders, one partition per ISO week, for offline recomputation of past weeks.
+    A partition is a directory YYYY-Www holding three NumPy arrays sorted by merchant:
+
+    * merchant_id.npy: int64
+    * amount_cents.npy: int64
+    * completed_at.npy: datetime64[s]
+
+    Partitions always hold whole weeks, an export is widened to the Monday of the week of start and the Sunday of the
+    week of end, and a partition is written aside then renamed into place, so a calculation never reads part of a week.
+    The partitions of the weeks exported without completed orders, as weeks whose orders were all reverted, are
+    removed.
+
+    The calculator reads the partitions memory-mapped and computes the disbursements with the fee rules of
+    sequra.fees, without Flask nor a database, so auditing a year does not reload the seed.
+
+    Usage: python sequra/snapshot.py export --output /tmp/orders --start 2018-01-01 --end 2018-12-31
+           python sequra/snapshot.py calculate --input /tmp/orders [--start 2018-01-01 --end 2018-01-31]
+"""
+import argparse
+import csv
+import datetime
+import logging
+import shutil
+import sys
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+
+import numpy as np
+
+from sequra import fees, settings
+
+log = logging.getLogger(__name__)
+
+COLUMNS = {'merchant_id': np.int64, 'amount_cents': np.int64, 'completed_at': 'datetime64[s]'}
+
+
+def partition_name(year, week):
+    return f'{year}-W{week:02d}'
+
+
+def _write_partition(output: Path, year, week, orders):
+    """ orders are (merchant id, amount in cents, completed at) """
+    columns = {name: np.array(values, dtype=dtype) for (name, dtype), values in zip(COLUMNS.items(), zip(*orders))}
+    order = np.argsort(columns['merchant_id'], kind='stable')
+    partition = output / partition_name(year, week)
+    output.mkdir(parents=True, exist_ok=True)
+    # Directories starting with a dot are not partitions, they are skipped by partitions() meanwhile
+    written = Path(tempfile.mkdtemp(prefix=f'.{partition.name}.', dir=output))
+    for name, values in columns.items():
+        np.save(written / f'{name}.npy', values[order])
+    if partition.exists():
+        replaced = _move_aside(output, partition)
+        written.rename(partition)
+        shutil.rmtree(replaced)
+    else:
+        written.rename(partition)
+
+
+def _remove_partition(output: Path, partition: Path):
+    shutil.rmtree(_move_aside(output, partition))
+
+
+def _move_aside(output: Path, partition: Path):
+    """ Renames the partition into a directory skipped by partitions(), returns that directory """
+    replaced = Path(tempfile.mkdtemp(prefix=f'.{partition.name}.', dir=output))
+    partition.rename(replaced / partition.name)
+    return replaced
+
+
+def week_bounds(start=None, end=None):
+    """ Monday of the ISO week of start and Monday after the ISO week of end, as datetimes """
+    first = last = None
+    if start is not None:
+        first = datetime.datetime.combine(start - datetime.timedelta(days=start.weekday()), datetime.time())
+    if end is not None:
+        last = datetime.datetime.combine(end + datetime.timedelta(days=7 - end.weekday()), datetime.time())
+    return first, last
+
+
+def export(output: Path, start=None, end=None):
+    """ Writes a partition per ISO week with completed orders, of the weeks from the one of start to the one of end,
+    and removes the partitions of the other weeks of the range, returns the partitions written """
+    from sequra.database import db
+    from sequra.database.models import Order
+    query = db.session.query(Order.completed_year, Order.completed_week, Order.merchant_id, Order.amount_cents,
+                             Order.completed_at).filter(Order.completed_at.isnot(None))
+    first, last = week_bounds(start, end)
+    if first is not None:
+        query = query.filter(Order.completed_at >= first)
+    if last is not None:
+        query = query.filter(Order.completed_at < last)
+    rows = query.order_by(Order.completed_at).yield_per(settings.BACKFILL_BATCH_SIZE)
+
+    written = set()
+    for (year, week), orders in groupby(rows, key=itemgetter(0, 1)):
+        orders = [(merchant_id, cents, completed_at) for _, _, merchant_id, cents, completed_at in orders]
+        _write_partition(output, year, week, orders)
+        written.add((year, week))
+        log.info('Exported week %s of %s, %s orders', week, year, len(orders))
+    if output.exists():
+        for year, week, path in partitions(output, start, end):
+            if (year, week) not in written:
+                _remove_partition(output, path)
+                log.info('Removed week %s of %s, without completed orders', week, year)
+    return len(written)
+
+
+def read_partition(partition: Path):
+    """ Memory-mapped columns of a partition """
+    return {name: np.load(partition / f'{name}.npy', mmap_mode='r') for name in COLUMNS}
+
+
+def partitions(snapshot: Path, start=None, end=None):
+    """ (year, week, path) of the partitions of the weeks between start and end, ordered by week """
+    first = tuple(start.isocalendar()[:2]) if start else (0, 0)
+    last = tuple(end.isocalendar()[:2]) if end else (sys.maxsize, 0)
+    found = []
+    for path in snapshot.iterdir():
+        year, _, week = path.name.partition('-W')
+        if path.is_dir() and year.isdigit() and week.isdigit() and first <= (int(year), int(week)) <= last:
+            found.append((int(year), int(week), path))
+    return sorted(found)
+
+
+def calculate(snapshot: Path, start=None, end=None):
+    """ Yields (year, week, merchant id, disbursed cents) of every merchant with completed orders in a week """
+    for year, week, path in partitions(snapshot, start, end):
+        columns = read_partition(path)
+        disbursed = fees.disbursed_cents_by_merchant(columns['merchant_id'], columns['amount_cents'])
+        for merchant_id, cents in disbursed.items():
+            yield year, week, merchant_id, cents
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Export completed orders by week and calculate disbursements from them')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help='write the weekly partitions from the database')
+    export_parser.add_argument('--output', type=Path, required=True)
+    calculate_parser = commands.add_parser('calculate', help='print the disbursements of the partitions as CSV')
+    calculate_parser.add_argument('--input', type=Path, required=True)
+    for command_parser in (export_parser, calculate_parser):
+        command_parser.add_argument('--start', type=datetime.date.fromisoformat)
+        command_parser.add_argument('--end', type=datetime.date.fromisoformat)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'calculate':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(['year', 'week', 'merchant_id', 'amount'])
+        for year, week, merchant_id, cents in calculate(args.input, args.start, args.end):
+            writer.writerow([year, week, merchant_id, fees.from_cents(cents)])
+        return
+    from sequra import app as flask_app
+    flask_app.create_app(serve_api=False)
+    with flask_app.app.app_context():
+        export(args.output, args.start, args.end)
+
+
+if __name__ == "__main__":
+    main()
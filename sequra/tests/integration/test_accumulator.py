@@ -0,0 +1,95 @@
+from datetime import date
+from decimal import Decimal
+from unittest import TestCase
+
+from sequra import app as flask_app
+from sequra.database import db
+from sequra.database.models import DisbursementAccumulator, Merchant, Order, Shopper
+from sequra.reconcile import reconcile
+
+
+class TestAccumulator(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        flask_app.configure_app(flask_app=flask_app.app)
+        db.init_app(flask_app.app)
+
+    def setUp(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add(Merchant(id=1, cif='11111111H', email='merchant_1@test.org', name='merchant_1'))
+            db.session.add(Shopper(id=1, email='shopper_1@test.org', name='shopper 1', nif='9999999G'))
+            db.session.add(Order(id=1, merchant_id=1, shopper_id=1, amount=Decimal('50.00'),
+                                 created_at=date(2020, 1, 1), completed_at=None))
+            db.session.commit()
+
+    def tearDown(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+
+    def test_order_completed(self):
+        with flask_app.app.app_context():
+            Order.query.get(1).completed_at = date(2020, 1, 1)
+            db.session.commit()
+
+            self.assertEqual(DisbursementAccumulator.amount(merchant_id=1, week=1, year=2020), Decimal('50.48'))
+            self.assertDictEqual(DisbursementAccumulator.reconcile(), {})
+
+    def test_order_completion_reverted(self):
+        with flask_app.app.app_context():
+            Order.query.get(1).completed_at = date(2020, 1, 1)
+            db.session.commit()
+            Order.query.get(1).completed_at = None
+            db.session.commit()
+
+            self.assertEqual(DisbursementAccumulator.amount(merchant_id=1, week=1, year=2020), Decimal('0.00'))
+            self.assertDictEqual(DisbursementAccumulator.reconcile(), {})
+
+    def test_order_moved_to_another_week(self):
+        with flask_app.app.app_context():
+            Order.query.get(1).completed_at = date(2020, 1, 1)
+            db.session.commit()
+            order = Order.query.get(1)
+            order.completed_at = date(2020, 1, 8)
+            order.amount = Decimal('1.00')
+            db.session.commit()
+
+            self.assertEqual(DisbursementAccumulator.amount(merchant_id=1, week=1, year=2020), Decimal('0.00'))
+            self.assertEqual(DisbursementAccumulator.amount(merchant_id=1, week=2, year=2020), Decimal('1.01'))
+            self.assertDictEqual(DisbursementAccumulator.reconcile(), {})
+
+    def test_completed_order_deleted(self):
+        with flask_app.app.app_context():
+            db.session.add(Order(id=2, merchant_id=1, shopper_id=1, amount=Decimal('1.00'),
+                                 created_at=date(2020, 1, 1), completed_at=date(2020, 1, 1)))
+            db.session.commit()
+            db.session.delete(Order.query.get(2))
+            db.session.commit()
+
+            self.assertEqual(DisbursementAccumulator.amount(merchant_id=1, week=1, year=2020), Decimal('0.00'))
+            self.assertDictEqual(DisbursementAccumulator.reconcile(), {})
+
+    def test_reconcile_bulk_insert(self):
+        with flask_app.app.app_context():
+            db.session.execute(Order.__table__.insert(), [{
+                'id': 2, 'merchant_id': 1, 'shopper_id': 1, 'amount_cents': 100, 'created_at': date(2020, 1, 1),
+                'completed_at': date(2020, 1, 1), 'completed_year': 2020, 'completed_week': 1}])
+            db.session.commit()
+
+            self.assertDictEqual(DisbursementAccumulator.reconcile(), {(1, 2020, 1): ((0, 0, 0), (1010000, 1, 100))})
+            DisbursementAccumulator.rebuild()
+            self.assertDictEqual(DisbursementAccumulator.reconcile(), {})
+
+    def test_reconcile_order_amounts(self):
+        with flask_app.app.app_context():
+            db.session.add(Order(id=2, merchant_id=1, shopper_id=1, amount=Decimal('1.00'),
+                                 created_at=date(2020, 1, 1), completed_at=date(2020, 1, 1)))
+            db.session.commit()
+            table = DisbursementAccumulator.__table__
+            db.session.execute(table.update().values(orders=2, amount_cents=150))
+            db.session.commit()
+
+            self.assertDictEqual(reconcile(repair=True), {(1, 2020, 1): ((1010000, 2, 150), (1010000, 1, 100))})
+            self.assertDictEqual(DisbursementAccumulator.reconcile(), {})
@@ -0,0 +1,98 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from datetime import date
+from decimal import Decimal
+from unittest import TestCase
+from unittest.mock import patch
+
+from sequra import app as flask_app
+from sequra.backfill import backfill, iso_weeks
+from sequra.database import db
+from sequra.database.models import BackfillWeek, Disbursement, Merchant, Order, Shopper
+from sequra.jobs import job_queue
+
+
+class TestBackfill(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        flask_app.initialize_app(flask_app=flask_app.app)
+        db.init_app(flask_app.app)
+
+    def setUp(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add(Merchant(id=1, cif='11111111H', email='merchant_1@test.org', name='merchant_1'))
+            db.session.add(Merchant(id=2, cif='222222222I', email='merchant_2@test.org', name='merchant_2'))
+            db.session.add(Shopper(id=1, email='shopper_1@test.org', name='shopper 1', nif='9999999G'))
+            for merchant_id, amount, completed_at in ((1, '1.00', date(2019, 12, 30)), (2, '50.00', date(2020, 1, 5)),
+                                                      (1, '300.00', date(2020, 1, 13))):
+                db.session.add(Order(merchant_id=merchant_id, shopper_id=1, amount=Decimal(amount),
+                                     created_at=date(2019, 12, 1), completed_at=completed_at))
+            db.session.commit()
+
+    def tearDown(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+
+    def test_iso_weeks(self):
+        self.assertListEqual(iso_weeks(date(2020, 12, 30), date(2021, 1, 4)), [(2020, 53), (2021, 1)])
+
+    def test_backfill(self):
+        with flask_app.app.app_context():
+            written = backfill(date(2020, 1, 1), date(2020, 1, 19))
+            disbursements = {(dis.merchant_id, dis.year, dis.week): dis.amount for dis in Disbursement.query}
+
+        self.assertEqual(written, 3)
+        self.assertDictEqual(disbursements, {
+            (1, 2020, 1): Decimal('1.01'), (2, 2020, 1): Decimal('50.48'),
+            (1, 2020, 2): Decimal('0.00'), (2, 2020, 2): Decimal('0.00'),
+            (1, 2020, 3): Decimal('302.55'), (2, 2020, 3): Decimal('0.00')})
+
+    def test_backfill_resumes(self):
+        with flask_app.app.app_context():
+            db.session.add(BackfillWeek(year=2020, week=1, merchants=2, orders=2))
+            db.session.commit()
+
+            self.assertEqual(backfill(date(2020, 1, 1), date(2020, 1, 19)), 2)
+            self.assertEqual(backfill(date(2020, 1, 1), date(2020, 1, 19)), 0)
+            self.assertEqual(Disbursement.query.filter_by(week=1).count(), 0)
+
+    def test_backfill_overlapping(self):
+        with flask_app.app.app_context():
+            backfill(date(2020, 1, 1), date(2020, 1, 19))
+            # Another backfill read the checkpoints before this one wrote them
+            with patch.object(BackfillWeek, 'done', return_value=set()):
+                self.assertEqual(backfill(date(2020, 1, 1), date(2020, 1, 19)), 3)
+
+            self.assertEqual(BackfillWeek.query.count(), 3)
+            self.assertEqual(Disbursement.query.count(), 6)
+
+    def test_backfill_processes_migrate_first(self):
+        with tempfile.TemporaryDirectory() as directory:
+            environment = dict(os.environ, SEQURA_DATABASE_URI=f'sqlite:///{directory}/sequra.db', SEQURA_SEED='never')
+            subprocess.run([sys.executable, '-m', 'sequra.backfill', '--start', '2020-01-01', '--end', '2020-01-19',
+                            '--processes', '2'], env=environment, capture_output=True, check=True)
+            with sqlite3.connect(f'{directory}/sequra.db') as connection:
+                weeks = connection.execute('SELECT year, week FROM backfill_week ORDER BY week').fetchall()
+
+        self.assertListEqual(weeks, [(2020, 1), (2020, 2), (2020, 3)])
+
+    def test_post_backfill(self):
+        with flask_app.app.test_client() as client:
+            response = client.post("/backfill", query_string={'start': '2020-01-01', 'end': '2020-01-19'})
+            job_queue.wait()
+            progress = client.get(response.headers['Location'])
+
+            self.assertEqual(response.status_code, 202)
+            self.assertDictEqual(progress.json, {'weeks': 3, 'done': 3, 'pending': []})
+
+    def test_post_backfill_invalid_range(self):
+        with flask_app.app.test_client() as client:
+            response = client.post("/backfill", query_string={'start': '2020-01-19', 'end': '2020-01-01'})
+
+            self.assertEqual(response.status_code, 400)
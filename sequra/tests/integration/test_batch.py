@@ -0,0 +1,69 @@
+from datetime import date
+from decimal import Decimal
+from unittest import TestCase
+from unittest.mock import patch
+
+from sequra import app as flask_app
+from sequra.batch import calculate_week, disburse_week
+from sequra.database import db
+from sequra.database.models import Disbursement, DisbursementAccumulator, Merchant, Order, Shopper
+
+
+class TestBatch(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        flask_app.configure_app(flask_app=flask_app.app)
+        db.init_app(flask_app.app)
+
+    def setUp(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add(Merchant(id=1, cif='11111111H', email='merchant_1@test.org', name='merchant_1'))
+            db.session.add(Merchant(id=2, cif='222222222I', email='merchant_2@test.org', name='merchant_2'))
+            db.session.add(Shopper(id=1, email='shopper_1@test.org', name='shopper 1', nif='9999999G'))
+            for amount in (Decimal('1.00'), Decimal('100.00')):
+                db.session.add(Order(merchant_id=1, shopper_id=1, amount=amount,
+                                     created_at=date(2020, 1, 1), completed_at=date(2020, 1, 1)))
+            db.session.commit()
+
+    def tearDown(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+
+    def test_disburse_week(self):
+        with flask_app.app.app_context():
+            amounts = disburse_week(year=2020, week=1)
+            disbursements = {dis.merchant_id: dis.amount for dis in Disbursement.query.filter_by(year=2020, week=1)}
+
+        self.assertDictEqual(amounts, {1: Decimal('101.96'), 2: Decimal('0.00')})
+        self.assertDictEqual(disbursements, amounts)
+
+    def test_disburse_week_twice_updates(self):
+        with flask_app.app.app_context():
+            disburse_week(year=2020, week=1)
+            db.session.add(Order(merchant_id=2, shopper_id=1, amount=Decimal('1.00'),
+                                 created_at=date(2020, 1, 1), completed_at=date(2020, 1, 1)))
+            db.session.commit()
+            disburse_week(year=2020, week=1)
+
+            self.assertEqual(Disbursement.query.count(), 2)
+            self.assertEqual(Disbursement.query.filter_by(merchant_id=2).one().amount, Decimal('1.01'))
+
+    def test_disburse_week_matches_per_merchant(self):
+        with flask_app.app.app_context():
+            amounts = disburse_week(year=2020, week=1)
+            for merchant_id, amount in amounts.items():
+                self.assertEqual(Disbursement.calculate_amount(merchant_id=merchant_id, week=1, year=2020), amount)
+
+    def test_calculate_week_reads_only_merchant_ids(self):
+        for list_max_size in (500, 0):
+            with patch('sequra.database.models.MERCHANT_LIST_MAX_SIZE', list_max_size), \
+                    flask_app.app.app_context():
+                merchant_ids, _ = Order.amounts_in_week(week=1, year=2020, merchant_ids=[2])
+
+                self.assertListEqual(merchant_ids.tolist(), [])
+                self.assertDictEqual(DisbursementAccumulator.amounts_in_week(week=1, year=2020, merchant_ids=[2]), {})
+                self.assertDictEqual(calculate_week(year=2020, week=1, merchant_ids=[2]), {2: Decimal('0.00')})
+                self.assertDictEqual(calculate_week(year=2020, week=1, merchant_ids=[1]), {1: Decimal('101.96')})
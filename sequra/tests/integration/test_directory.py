@@ -0,0 +1,55 @@
+from unittest import TestCase
+
+from sequra import app as flask_app
+from sequra.database import db
+from sequra.database.models import Merchant, TableVersion
+from sequra.directory import MerchantDirectory
+
+
+class TestMerchantDirectory(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        flask_app.configure_app(flask_app=flask_app.app)
+        db.init_app(flask_app.app)
+
+    def setUp(self):
+        self.now = 0
+        self.directory = MerchantDirectory(check_interval=5, clock=lambda: self.now)
+        with flask_app.app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add(Merchant(id=1, cif='11111111H', email='merchant_1@test.org', name='merchant_1'))
+            db.session.commit()
+
+    def tearDown(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+
+    def test_id_of(self):
+        with flask_app.app.app_context():
+            self.directory.load()
+
+            self.assertEqual(self.directory.id_of('merchant_1'), 1)
+            self.assertIsNone(self.directory.id_of('invalid'))
+            self.assertDictEqual(self.directory.stats(), {'size': 1, 'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+    def test_merchant_written_bumps_version(self):
+        with flask_app.app.app_context():
+            version = TableVersion.current('merchant')
+            db.session.add(Merchant(id=2, cif='222222222I', email='merchant_2@test.org', name='merchant_2'))
+            db.session.commit()
+
+            self.assertEqual(TableVersion.current('merchant'), version + 1)
+
+    def test_reloaded_when_version_changes(self):
+        with flask_app.app.app_context():
+            self.directory.load()
+            # Written by another worker, without the events of this process
+            db.session.execute(Merchant.__table__.update().values(name='renamed'))
+            TableVersion.bump(db.session.connection(), 'merchant')
+            db.session.commit()
+
+            self.assertEqual(self.directory.merchants(), {1: 'merchant_1'})
+            self.now = 5
+            self.assertEqual(self.directory.merchants(), {1: 'renamed'})
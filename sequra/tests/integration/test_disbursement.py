@@ -1,10 +1,15 @@
+import json
+import threading
 from datetime import date
 from decimal import Decimal
 from unittest import TestCase
 
 from sequra import app as flask_app
+from sequra.api.resource.disbursement import GetBusiness
+from sequra.cache import disbursement_cache
 from sequra.database import db
-from sequra.database.models import Disbursement, Merchant, Order, Shopper
+from sequra.database.models import Disbursement, Merchant, Order, Shopper, TableVersion
+from sequra.jobs import job_queue
 
 
 class TestCompetitionInfo(TestCase):
@@ -15,6 +20,7 @@ class TestCompetitionInfo(TestCase):
         db.init_app(flask_app.app)
 
     def setUp(self):
+        disbursement_cache.clear()
         with flask_app.app.app_context():
             db.drop_all()
             db.create_all()
@@ -38,10 +44,74 @@ class TestCompetitionInfo(TestCase):
         with flask_app.app.test_client() as client:
             data = {'week': 1, 'year': 2020, 'merchant_name': 'merchant_1'}
             client.get("/calculate_disbursement", query_string=data)
+            job_queue.wait()
             response = client.get("/disbursement", query_string=data)
 
             self.assertDictEqual(response.json, {'amount': 1.01, 'week': 1, 'year': 2020, 'merchant': 'merchant_1'})
 
+    def test_get_calculate_disbursement_enqueues_job(self):
+        with flask_app.app.test_client() as client:
+            data = {'week': 1, 'year': 2020, 'merchant_name': 'merchant_1'}
+            response = client.get("/calculate_disbursement", query_string=data)
+            job_queue.wait()
+            job = client.get(response.headers['Location'])
+
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(job.json['status'], 'done')
+            self.assertEqual(job.json['disbursement_id'], 1)
+
+    def test_get_calculate_disbursement_twice(self):
+        with flask_app.app.test_client() as client:
+            data = {'week': 1, 'year': 2020, 'merchant_name': 'merchant_1'}
+            first = client.get("/calculate_disbursement", query_string=data)
+            second = client.get("/calculate_disbursement", query_string=data)
+            job_queue.wait()
+            jobs = [client.get(response.headers['Location']).json for response in (first, second)]
+            response = client.get("/disbursement", query_string=data)
+
+            self.assertListEqual([job['status'] for job in jobs], ['done', 'done'])
+            self.assertEqual(jobs[0]['disbursement_id'], jobs[1]['disbursement_id'])
+            self.assertDictEqual(response.json, {'amount': 1.01, 'week': 1, 'year': 2020, 'merchant': 'merchant_1'})
+
+    def test_get_calculate_disbursement_invalid_name(self):
+        with flask_app.app.test_client() as client:
+            data = {'week': 1, 'year': 2020, 'merchant_name': 'invalid'}
+            response = client.get("/calculate_disbursement", query_string=data)
+
+            self.assertEqual(response.status_code, 404)
+
+    def test_post_calculate_disbursements(self):
+        with flask_app.app.app_context():
+            db.session.add(Merchant(id=2, cif='222222222I', email='merchant_2@test.org', name='merchant_2'))
+            db.session.commit()
+        with flask_app.app.test_client() as client:
+            response = client.post("/calculate_disbursement", json={
+                'week': 1, 'year': 2020, 'merchant_names': ['merchant_1', 'merchant_2']})
+            again = client.post("/calculate_disbursement", json={'week': 1, 'year': 2020, 'merchant_names': 'all'})
+            disbursements = client.get("/disbursement", query_string={'week': 1, 'year': 2020})
+
+            self.assertEqual(response.status_code, 201)
+            self.assertListEqual(response.json['disbursements'], [{'id': 1, 'merchant': 'merchant_1', 'amount': 1.01},
+                                                                  {'id': 2, 'merchant': 'merchant_2', 'amount': 0.0}])
+            self.assertListEqual(again.json['disbursements'], response.json['disbursements'])
+            self.assertEqual(len(disbursements.json), 2)
+
+    def test_post_calculate_disbursements_invalid_name(self):
+        with flask_app.app.test_client() as client:
+            response = client.post("/calculate_disbursement", json={
+                'week': 1, 'year': 2020, 'merchant_names': ['merchant_1', 'invalid']})
+            invalid = client.post("/calculate_disbursement", json={'week': 1, 'year': 2020, 'merchant_names': 'some'})
+
+            self.assertEqual(response.status_code, 404)
+            self.assertIn('invalid', response.json['message'])
+            self.assertEqual(invalid.status_code, 400)
+
+    def test_get_job_not_found(self):
+        with flask_app.app.test_client() as client:
+            response = client.get("/jobs/1")
+
+            self.assertEqual(response.status_code, 404)
+
     def test_get_no_disbursement(self):
         with flask_app.app.test_client() as client:
             response = client.get("/disbursement", query_string={'week': 1, 'year': 2020})
@@ -83,3 +153,122 @@ class TestCompetitionInfo(TestCase):
 
             self.assertListEqual(response.json, [{'amount': 1.01, 'week': 1, 'year': 2020, 'merchant': 'merchant_1'},
                                                  {'amount': 1.01, 'week': 1, 'year': 2020, 'merchant': 'merchant_2'}])
+
+    def test_get_disbursement_cached(self):
+        with flask_app.app.app_context():
+            db.session.add(Disbursement(amount=Decimal('1.00'), week=1, year=2020, merchant_id=1))
+            db.session.commit()
+        with flask_app.app.test_client() as client:
+            data = {'week': 1, 'year': 2020, 'merchant_name': 'merchant_1'}
+            first = client.get("/disbursement", query_string=data)
+            second = client.get("/disbursement", query_string=data)
+
+            self.assertEqual(first.headers['X-Cache'], 'MISS')
+            self.assertEqual(second.headers['X-Cache'], 'HIT')
+            self.assertDictEqual(second.json, first.json)
+
+    def test_get_disbursements_invalidated_on_write(self):
+        with flask_app.app.test_client() as client:
+            client.get("/disbursement", query_string={'week': 1, 'year': 2020})
+            with flask_app.app.app_context():
+                db.session.add(Disbursement(amount=Decimal('1.00'), week=1, year=2020, merchant_id=1))
+                db.session.commit()
+            response = client.get("/disbursement", query_string={'week': 1, 'year': 2020})
+
+            self.assertEqual(response.headers['X-Cache'], 'MISS')
+            self.assertEqual(len(response.json), 1)
+
+    def test_cache_invalidated_on_commit(self):
+        with flask_app.app.app_context():
+            disbursement_cache.set((None, 2020, 1), 'cached')
+            db.session.add(Disbursement(amount=Decimal('1.00'), week=1, year=2020, merchant_id=1))
+            db.session.flush()
+            # A reader between the flush and the commit caches the amounts before the write
+            self.assertEqual(disbursement_cache.get((None, 2020, 1)), 'cached')
+            db.session.commit()
+
+            self.assertIsNone(disbursement_cache.get((None, 2020, 1)))
+
+    def test_cache_kept_on_rollback(self):
+        with flask_app.app.app_context():
+            db.session.add(Disbursement(amount=Decimal('1.00'), week=1, year=2020, merchant_id=1))
+            db.session.flush()
+            db.session.rollback()
+            disbursement_cache.set((None, 2020, 1), 'cached')
+            db.session.commit()
+
+            self.assertEqual(disbursement_cache.get((None, 2020, 1)), 'cached')
+
+    def test_table_version_bumped_on_write(self):
+        with flask_app.app.app_context():
+            version = TableVersion.current('disbursement')
+            db.session.add(Disbursement(amount=Decimal('1.00'), week=1, year=2020, merchant_id=1))
+            db.session.commit()
+            self.assertEqual(TableVersion.current('disbursement'), version + 1)
+
+            Disbursement.bulk_upsert(week=2, year=2020, amounts={1: Decimal('2.00')})
+            self.assertEqual(TableVersion.current('disbursement'), version + 2)
+
+    def _add_two_merchant_disbursements(self):
+        with flask_app.app.app_context():
+            db.session.add(Merchant(id=2, cif='222222222I', email='merchant_2@test.org', name='merchant_2'))
+            db.session.add(Disbursement(amount=Decimal('1.00'), week=1, year=2020, merchant_id=1))
+            db.session.add(Disbursement(amount=Decimal('1.00'), week=1, year=2020, merchant_id=2))
+            db.session.commit()
+
+    def test_get_disbursements_paginated(self):
+        self._add_two_merchant_disbursements()
+        with flask_app.app.test_client() as client:
+            first = client.get("/disbursement", query_string={'week': 1, 'year': 2020, 'limit': 1})
+            second = client.get("/disbursement", query_string={
+                'week': 1, 'year': 2020, 'limit': 1, 'after': first.headers['X-Next-Cursor']})
+
+            self.assertListEqual(first.json, [{'amount': 1.01, 'week': 1, 'year': 2020, 'merchant': 'merchant_1'}])
+            self.assertListEqual(second.json, [{'amount': 0.0, 'week': 1, 'year': 2020, 'merchant': 'merchant_2'}])
+            self.assertNotIn('X-Next-Cursor', second.headers)
+
+    def test_get_disbursements_ndjson(self):
+        self._add_two_merchant_disbursements()
+        with flask_app.app.test_client() as client:
+            response = client.get("/disbursement", query_string={'week': 1, 'year': 2020, 'format': 'ndjson'})
+
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            self.assertListEqual([json.loads(line) for line in response.data.decode().splitlines()],
+                                 [{'amount': 1.01, 'week': 1, 'year': 2020, 'merchant': 'merchant_1'},
+                                  {'amount': 0.0, 'week': 1, 'year': 2020, 'merchant': 'merchant_2'}])
+
+    def test_get_disbursements_csv(self):
+        self._add_two_merchant_disbursements()
+        with flask_app.app.test_client() as client:
+            response = client.get("/disbursement", query_string={'week': 1, 'year': 2020, 'format': 'csv'})
+
+            self.assertEqual(response.mimetype, 'text/csv')
+            self.assertListEqual(response.data.decode().splitlines(), ['merchant,year,week,amount',
+                                                                       'merchant_1,2020,1,1.01',
+                                                                       'merchant_2,2020,1,0.00'])
+
+    def test_read_during_job_keeps_its_writes(self):
+        written, release = threading.Event(), threading.Event()
+
+        def write():
+            db.session.execute(Disbursement.__table__.insert().values(merchant_id=1, year=2020, week=1,
+                                                                      amount_cents=101))
+            written.set()
+            release.wait(5)
+            db.session.commit()
+
+        def read():
+            with flask_app.app.app_context():
+                GetBusiness.disbursements(merchant_id=None, year=2020, week=1)
+
+        job_queue.submit(write)
+        written.wait(5)
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join(0.2)
+        release.set()
+        job_queue.wait()
+        reader.join()
+
+        with flask_app.app.app_context():
+            self.assertEqual(Disbursement.query.count(), 1)
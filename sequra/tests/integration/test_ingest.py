@@ -0,0 +1,134 @@
+from datetime import date
+from decimal import Decimal
+from unittest import TestCase
+from unittest.mock import patch
+
+from sequra import app as flask_app
+from sequra.database import db
+from sequra.database.models import DisbursementAccumulator, Merchant, Order, Shopper
+from sequra.ingest import ingest_buffer, write_events
+from sequra.jobs import job_queue
+
+
+class TestIngest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        flask_app.initialize_app(flask_app=flask_app.app)
+        db.init_app(flask_app.app)
+
+    def setUp(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add(Merchant(id=1, cif='11111111H', email='merchant_1@test.org', name='merchant_1'))
+            db.session.add(Shopper(id=1, email='shopper_1@test.org', name='shopper 1', nif='9999999G'))
+            db.session.add(Order(id=1, merchant_id=1, shopper_id=1, amount=Decimal('1.00'), created_at=date(2020, 1, 1)))
+            db.session.commit()
+
+    def tearDown(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+
+    def _flush(self):
+        job_queue.wait()
+        with flask_app.app.app_context():
+            ingest_buffer.flush()
+
+    def test_post_orders(self):
+        with flask_app.app.test_client() as client:
+            response = client.post("/orders", json=[
+                {'type': 'create', 'id': 2, 'merchant_id': 1, 'shopper_id': 1, 'amount': '50.00',
+                 'created_at': '2020-01-01T10:00:00', 'completed_at': '2020-01-02T10:00:00'},
+                {'type': 'create', 'id': 3, 'merchant_id': 1, 'shopper_id': 1, 'amount': '300.00',
+                 'created_at': '2020-01-01T10:00:00'},
+                {'type': 'complete', 'id': 1, 'completed_at': '2020-01-03T10:00:00'}])
+            self._flush()
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json['accepted'], 3)
+        with flask_app.app.app_context():
+            self.assertEqual(Order.query.count(), 3)
+            self.assertEqual(Order.query.get(1).completed_week, 1)
+            self.assertIsNone(Order.query.get(3).completed_at)
+            self.assertEqual(DisbursementAccumulator.amount(merchant_id=1, week=1, year=2020), Decimal('51.49'))
+            self.assertDictEqual(DisbursementAccumulator.reconcile(), {})
+
+    def test_post_orders_ndjson(self):
+        with flask_app.app.test_client() as client:
+            response = client.post("/orders", content_type='application/x-ndjson', data='\n'.join([
+                '{"type": "complete", "id": 1, "completed_at": "2020-01-03T10:00:00"}',
+                '{"type": "complete", "id": 1, "completed_at": "2020-02-03T10:00:00"}', '']))
+            self._flush()
+
+        self.assertEqual(response.status_code, 202)
+        with flask_app.app.app_context():
+            self.assertEqual(Order.query.get(1).completed_week, 6)
+            self.assertDictEqual(DisbursementAccumulator.reconcile(), {})
+
+    def test_post_orders_invalid(self):
+        with flask_app.app.test_client() as client:
+            missing = client.post("/orders", json=[{'type': 'create', 'id': 2, 'merchant_id': 1}])
+            unknown_merchant = client.post("/orders", json=[
+                {'type': 'create', 'id': 2, 'merchant_id': 9, 'shopper_id': 1, 'amount': '1.00',
+                 'created_at': '2020-01-01T10:00:00'}])
+            not_array = client.post("/orders", json={'type': 'complete', 'id': 1})
+
+        self.assertEqual(missing.status_code, 400)
+        self.assertIn('amount', missing.json['message'])
+        self.assertEqual(unknown_merchant.status_code, 400)
+        self.assertEqual(not_array.status_code, 400)
+        self.assertEqual(ingest_buffer.depth, 0)
+
+    def test_post_orders_replayed(self):
+        with flask_app.app.test_client() as client:
+            new = client.post("/orders", json=[
+                {'type': 'create', 'id': 2, 'merchant_id': 1, 'shopper_id': 1, 'amount': '50.00',
+                 'created_at': '2020-01-01T10:00:00', 'completed_at': '2020-01-02T10:00:00'}])
+            replayed = client.post("/orders", json=[
+                {'type': 'create', 'id': 1, 'merchant_id': 1, 'shopper_id': 1, 'amount': '1.00',
+                 'created_at': '2020-01-01T10:00:00', 'completed_at': '2020-01-02T10:00:00'},
+                {'type': 'create', 'id': 2, 'merchant_id': 1, 'shopper_id': 1, 'amount': '50.00',
+                 'created_at': '2020-01-01T10:00:00', 'completed_at': '2020-01-02T10:00:00'}])
+            self._flush()
+
+        self.assertEqual((new.status_code, replayed.status_code), (202, 202))
+        with flask_app.app.app_context():
+            self.assertEqual(Order.query.count(), 2)
+            self.assertIsNone(Order.query.get(1).completed_at)
+            self.assertEqual(DisbursementAccumulator.amount(merchant_id=1, week=1, year=2020), Decimal('50.48'))
+            self.assertDictEqual(DisbursementAccumulator.reconcile(), {})
+
+    def test_post_orders_rejected_one_by_one(self):
+        failed, rejected = ingest_buffer.failed, ingest_buffer.rejected
+        with flask_app.app.test_client() as client:
+            client.post("/orders", json=[
+                {'type': 'create', 'id': 2, 'merchant_id': 1, 'shopper_id': 9, 'amount': '50.00',
+                 'created_at': '2020-01-01T10:00:00'},
+                {'type': 'complete', 'id': 7, 'completed_at': '2020-01-02T10:00:00'},
+                {'type': 'create', 'id': 3, 'merchant_id': 1, 'shopper_id': 1, 'amount': '50.00',
+                 'created_at': '2020-01-01T10:00:00'}])
+            self._flush()
+
+        self.assertEqual(ingest_buffer.rejected - rejected, 2)
+        self.assertEqual(ingest_buffer.failed, failed)
+        with flask_app.app.app_context():
+            self.assertListEqual([order.id for order in Order.query.order_by(Order.id)], [1, 3])
+
+    def test_failed_batch_written_event_by_event(self):
+        def write_unless_order_3(events):
+            if any(event['id'] == 3 for event in events):
+                raise ValueError('order 3')
+            return write_events(events)
+
+        failed = ingest_buffer.failed
+        with patch('sequra.ingest.write_events', side_effect=write_unless_order_3), \
+                flask_app.app.test_client() as client:
+            client.post("/orders", json=[
+                {'type': 'create', 'id': order_id, 'merchant_id': 1, 'shopper_id': 1, 'amount': '50.00',
+                 'created_at': '2020-01-01T10:00:00'} for order_id in (2, 3)])
+            self._flush()
+
+        self.assertEqual(ingest_buffer.failed - failed, 1)
+        with flask_app.app.app_context():
+            self.assertListEqual([order.id for order in Order.query.order_by(Order.id)], [1, 2])
@@ -0,0 +1,89 @@
+import datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+from sequra import app as flask_app
+from sequra.database import db
+from sequra.database.models import Disbursement, Job, Merchant
+from sequra.jobs import JobQueue
+
+
+class TestJobQueue(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        flask_app.initialize_app(flask_app=flask_app.app)
+        db.init_app(flask_app.app)
+
+    def setUp(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add(Merchant(id=1, cif='11111111H', email='merchant_1@test.org', name='merchant_1'))
+            db.session.commit()
+        patcher = patch.object(Disbursement, 'disburse', return_value=None)
+        self.disburse = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+
+    @staticmethod
+    def add_job(**columns):
+        job = Job(merchant_id=1, week=1, year=2020, **columns)
+        db.session.add(job)
+        db.session.commit()
+        return job.id
+
+    @staticmethod
+    def resume_in_workers(workers):
+        """ Every worker resumes the jobs, as the WSGI workers do when they start. The workers share the lock of the
+        in-memory database, a single connection in a single process """
+        queues = [JobQueue(flask_app.app) for _ in range(workers)]
+        for queue in queues:
+            queue._lock = queues[0]._lock
+            with queue._lock:
+                queue.resume()
+        for queue in queues:
+            queue.wait()
+            queue.shutdown()
+
+    def test_resume_pending_job_runs_once(self):
+        with flask_app.app.app_context():
+            job_id = self.add_job()
+            self.resume_in_workers(3)
+
+            job = Job.query.get(job_id)
+            self.assertEqual(job.status, Job.DONE)
+            self.assertEqual(job.owner, JobQueue().owner)
+        self.assertEqual(self.disburse.call_count, 1)
+
+    def test_resume_skips_job_claimed_by_running_worker(self):
+        with flask_app.app.app_context():
+            job_id = self.add_job(status=Job.RUNNING, owner='other:1', claimed_at=datetime.datetime.utcnow())
+            self.resume_in_workers(2)
+
+            job = Job.query.get(job_id)
+            self.assertEqual(job.status, Job.RUNNING)
+            self.assertEqual(job.owner, 'other:1')
+        self.disburse.assert_not_called()
+
+    def test_resume_reclaims_stale_job(self):
+        with flask_app.app.app_context():
+            claimed_at = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+            job_id = self.add_job(status=Job.RUNNING, owner='other:1', claimed_at=claimed_at)
+            self.resume_in_workers(2)
+
+            job = Job.query.get(job_id)
+            self.assertEqual(job.status, Job.DONE)
+            self.assertEqual(job.owner, JobQueue().owner)
+        self.assertEqual(self.disburse.call_count, 1)
+
+    def test_claim_once(self):
+        with flask_app.app.app_context():
+            job_id = self.add_job()
+            queue = JobQueue(flask_app.app)
+
+            self.assertTrue(queue.claim(job_id))
+            self.assertFalse(queue.claim(job_id))
@@ -0,0 +1,79 @@
+from datetime import date
+from decimal import Decimal
+from unittest import TestCase, mock
+
+from sqlalchemy.exc import OperationalError
+
+from sequra import app as flask_app
+from sequra import settings
+from sequra.cache import disbursement_cache
+from sequra.database import db
+from sequra.database.models import Merchant, Order, Shopper
+from sequra.jobs import job_queue
+from sequra.metrics import SPAN_SECONDS, SQL_QUERY_SECONDS
+
+
+class TestMetrics(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        flask_app.initialize_app(flask_app=flask_app.app)
+        db.init_app(flask_app.app)
+
+    def setUp(self):
+        disbursement_cache.clear()
+        with flask_app.app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add(Merchant(id=1, cif='11111111H', email='merchant_1@test.org', name='merchant_1'))
+            db.session.add(Shopper(id=1, email='shopper_1@test.org', name='shopper 1', nif='9999999G'))
+            db.session.add(Order(merchant_id=1, shopper_id=1, amount=Decimal('1.00'), created_at=date(2020, 1, 1),
+                                 completed_at=date(2020, 1, 1)))
+            db.session.commit()
+
+    def tearDown(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+
+    def test_failed_query_counted(self):
+        queries = SQL_QUERY_SECONDS.count(endpoint='background')
+        with flask_app.app.app_context():
+            with self.assertRaises(OperationalError):
+                db.session.execute('SELECT * FROM missing_table')
+            db.session.rollback()
+            db.session.execute('SELECT 1')
+
+            self.assertNotIn('query_start', db.session.connection().info)
+        self.assertEqual(SQL_QUERY_SECONDS.count(endpoint='background'), queries + 2)
+
+    def test_metrics(self):
+        data = {'week': 1, 'year': 2020, 'merchant_name': 'merchant_1'}
+        lookups = SPAN_SECONDS.count(span='merchant_lookup')
+        with flask_app.app.test_client() as client:
+            client.get("/calculate_disbursement", query_string=data)
+            job_queue.wait()
+            response = client.get("/disbursement", query_string=data)
+            metrics = client.get("/metrics")
+
+        self.assertGreater(int(response.headers['X-SQL-Queries']), 0)
+        self.assertEqual(SPAN_SECONDS.count(span='merchant_lookup'), lookups + 2)
+        self.assertEqual(metrics.status_code, 200)
+        self.assertEqual(metrics.mimetype, 'text/plain')
+        body = metrics.get_data(as_text=True)
+        self.assertIn('sequra_request_seconds_count{method="GET",endpoint="api._get_business",status="200"}', body)
+        self.assertIn('sequra_sql_queries_per_request_bucket', body)
+        self.assertIn('sequra_span_seconds_count{span="accumulated_amount"}', body)
+        self.assertIn('sequra_disbursement_cache_misses_total 1', body)
+        self.assertIn('sequra_job_queue_depth 0', body)
+
+    def test_profile(self):
+        data = {'week': 1, 'year': 2020, 'merchant_name': 'merchant_1'}
+        with flask_app.app.test_client() as client:
+            response = client.get("/disbursement", query_string=data, headers={'X-Profile': '1'})
+            self.assertEqual(response.mimetype, 'application/json')
+
+            with mock.patch.object(settings, 'PROFILING_ENABLED', True):
+                response = client.get("/disbursement", query_string=data, headers={'X-Profile': '1'})
+
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertIn('function calls', response.get_data(as_text=True))
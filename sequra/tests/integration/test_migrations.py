@@ -0,0 +1,122 @@
+import multiprocessing
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask
+
+from sequra import app as flask_app
+from sequra.database import db, engine_options
+from sequra.database.migrations import MIGRATIONS, current_version, migrate, reseed, schema_version
+from sequra.database.models import Disbursement, Merchant, Order
+
+
+def _migrate_process(database_uri, barrier):
+    migrating_app = Flask('migrating')
+    migrating_app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    migrating_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    migrating_app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(database_uri)
+    db.init_app(migrating_app)
+    barrier.wait()
+    with migrating_app.app_context():
+        migrate()
+
+
+class TestMigrations(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        flask_app.configure_app(flask_app=flask_app.app)
+        db.init_app(flask_app.app)
+
+    def setUp(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+
+    def tearDown(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+
+    def test_migrate(self):
+        with flask_app.app.app_context():
+            applied = migrate()
+
+            self.assertListEqual(applied, [version for version, _, _ in MIGRATIONS])
+            self.assertEqual(current_version(), MIGRATIONS[-1][0])
+            self.assertEqual(Merchant.query.count(), 14)
+
+    def test_migrate_once(self):
+        with flask_app.app.app_context():
+            migrate()
+
+            self.assertListEqual(migrate(), [])
+            self.assertEqual(Merchant.query.count(), 14)
+
+    @patch('sequra.settings.SEED_DATABASE', 'never')
+    def test_migrate_without_seed(self):
+        with flask_app.app.app_context():
+            migrate()
+
+            self.assertEqual(Merchant.query.count(), 0)
+
+    def test_reseed(self):
+        with flask_app.app.app_context():
+            migrate()
+            Order.query.filter(Order.id == 1).delete()
+            db.session.add(Disbursement(merchant_id=1, year=2020, week=1, amount_cents=1))
+            db.session.commit()
+
+            reseed()
+
+            self.assertEqual(Merchant.query.count(), 14)
+            self.assertIsNotNone(Order.query.get(1))
+            self.assertEqual(Disbursement.query.count(), 0)
+
+    def test_command_line_app_without_api(self):
+        modules = subprocess.run([sys.executable, '-c', 'import sys; from sequra import app, batch; '
+                                  'app.create_app(serve_api=False); print(" ".join(sys.modules))'],
+                                 capture_output=True, text=True, check=True).stdout.split()
+
+        self.assertNotIn('flask_restx', modules)
+        self.assertNotIn('marshmallow', modules)
+        self.assertIn('sequra.fees', modules)
+
+    def test_migrate_unique_disbursement_week(self):
+        with flask_app.app.app_context():
+            migrate()
+            db.session.execute('DROP INDEX ix_disbursement_year_week_merchant')
+            db.session.execute('CREATE INDEX ix_disbursement_year_week_merchant ON disbursement (year, week, merchant_id)')
+            db.session.execute(schema_version.delete().where(schema_version.c.version >= 3))
+            db.session.execute(Disbursement.__table__.insert(), [
+                {'merchant_id': 1, 'year': 2020, 'week': 1, 'amount_cents': amount_cents} for amount_cents in (1, 2)])
+            db.session.commit()
+
+            self.assertEqual(migrate()[0], 3)
+            self.assertListEqual(db.session.query(Disbursement.amount_cents).all(), [(2,)])
+            self.assertTrue(db.inspect(db.engine).get_indexes('disbursement')[0]['unique'])
+
+    @patch('sequra.settings.SEED_DATABASE', 'never')
+    def test_migrate_processes_starting_together(self):
+        context = multiprocessing.get_context('fork')
+        for _ in range(3):
+            with tempfile.TemporaryDirectory() as directory:
+                barrier = context.Barrier(8)
+                processes = [context.Process(target=_migrate_process, args=(f'sqlite:///{directory}/sequra.db', barrier))
+                             for _ in range(8)]
+                for process in processes:
+                    process.start()
+                for process in processes:
+                    process.join()
+
+                self.assertListEqual([process.exitcode for process in processes], [0] * 8)
+
+    def test_engine_options_memory(self):
+        self.assertDictEqual(engine_options('sqlite:///:memory:'), {})
+
+    def test_engine_options_file(self):
+        self.assertEqual(engine_options('sqlite:////tmp/sequra.db')['poolclass'].__name__, 'QueuePool')
+
+    def test_engine_options_postgresql(self):
+        self.assertTrue(engine_options('postgresql://localhost/sequra')['pool_pre_ping'])
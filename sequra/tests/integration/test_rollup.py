@@ -0,0 +1,158 @@
+from datetime import date
+from decimal import Decimal
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import event
+
+from sequra import app as flask_app
+from sequra.batch import disburse_week
+from sequra.database import db
+from sequra.database.models import (Disbursement, DisbursementMonth, DisbursementYear, Merchant, Order, Shopper,
+                                    month_of_week, rebuild_rollups, weeks_of_month)
+from sequra.directory import merchant_directory
+
+WEEKS = (1, 5, 6, 14)
+
+
+class TestRollup(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        flask_app.initialize_app(flask_app=flask_app.app)
+        db.init_app(flask_app.app)
+
+    def setUp(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add(Merchant(id=1, cif='11111111H', email='merchant_1@test.org', name='merchant_1'))
+            db.session.add(Merchant(id=2, cif='222222222I', email='merchant_2@test.org', name='merchant_2'))
+            db.session.add(Shopper(id=1, email='shopper_1@test.org', name='shopper 1', nif='9999999G'))
+            for merchant_id, amount, completed_at in ((1, Decimal('1.00'), date(2020, 1, 1)),
+                                                      (1, Decimal('100.00'), date(2020, 1, 28)),
+                                                      (2, Decimal('50.00'), date(2020, 2, 4)),
+                                                      (1, Decimal('10.00'), date(2020, 4, 1))):
+                db.session.add(Order(merchant_id=merchant_id, shopper_id=1, amount=amount,
+                                     created_at=completed_at, completed_at=completed_at))
+            db.session.commit()
+            merchant_directory.load()
+
+    def tearDown(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+
+    @staticmethod
+    def months():
+        return {(row.merchant_id, row.year, row.month): (row.amount_cents, row.fee_cents, row.disbursements)
+                for row in DisbursementMonth.query}
+
+    @staticmethod
+    def years():
+        return {(row.merchant_id, row.year): (row.amount_cents, row.fee_cents, row.disbursements)
+                for row in DisbursementYear.query}
+
+    def test_month_of_week(self):
+        self.assertEqual(month_of_week(2020, 1), 1)
+        self.assertEqual(month_of_week(2020, 14), 4)
+        self.assertEqual(month_of_week(2020, 53), 12)
+        self.assertListEqual(weeks_of_month(2020, 1), [1, 2, 3, 4, 5])
+        self.assertListEqual(weeks_of_month(2020, 2), [6, 7, 8, 9])
+
+    def test_bulk_upsert_rolls_up(self):
+        with flask_app.app.app_context():
+            for week in WEEKS:
+                disburse_week(year=2020, week=week)
+
+            self.assertDictEqual(self.months(), {
+                (1, 2020, 1): (10196, 96, 2), (1, 2020, 2): (0, 0, 1), (1, 2020, 4): (1010, 10, 1),
+                (2, 2020, 1): (0, 0, 2), (2, 2020, 2): (5048, 48, 1), (2, 2020, 4): (0, 0, 1)})
+            self.assertDictEqual(self.years(), {(1, 2020): (11206, 106, 4), (2, 2020): (5048, 48, 4)})
+
+    def test_recalculation_replaces_rollup(self):
+        with flask_app.app.app_context():
+            disburse_week(year=2020, week=1)
+            db.session.add(Order(merchant_id=1, shopper_id=1, amount=Decimal('1.00'), created_at=date(2020, 1, 1),
+                                 completed_at=date(2020, 1, 1)))
+            db.session.commit()
+            disburse_week(year=2020, week=1)
+
+            self.assertEqual(self.months()[(1, 2020, 1)], (202, 2, 1))
+            self.assertEqual(self.years()[(1, 2020)], (202, 2, 1))
+
+    def test_orm_writes_roll_up(self):
+        with flask_app.app.app_context():
+            disbursement = Disbursement(merchant_id=1, week=5, year=2020)
+            db.session.add(disbursement)
+            db.session.commit()
+
+            self.assertDictEqual(self.months(), {(1, 2020, 1): (10095, 95, 1)})
+
+            db.session.delete(disbursement)
+            db.session.commit()
+
+            self.assertDictEqual(self.months(), {})
+            self.assertDictEqual(self.years(), {})
+
+    @patch('sequra.settings.INCREMENTAL_DISBURSEMENTS', True)
+    def test_incremental_fees_from_accumulators(self):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with flask_app.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                disburse_week(year=2020, week=5)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+            self.assertFalse([statement for statement in statements if 'FROM "order"' in statement])
+            self.assertEqual(self.months()[(1, 2020, 1)], (10095, 95, 1))
+
+    def test_rebuild_matches_incremental(self):
+        with flask_app.app.app_context():
+            for week in WEEKS:
+                disburse_week(year=2020, week=week)
+            months, years = self.months(), self.years()
+            rebuild_rollups(db.session.connection())
+            db.session.commit()
+
+            self.assertDictEqual(self.months(), months)
+            self.assertDictEqual(self.years(), years)
+
+    def test_get_summary(self):
+        with flask_app.app.app_context():
+            for week in WEEKS:
+                disburse_week(year=2020, week=week)
+        with flask_app.app.test_client() as client:
+            months = client.get('/disbursement/summary', query_string={
+                'start': '2020-01-15', 'end': '2020-02-01', 'merchant_name': 'merchant_1'})
+            quarters = client.get('/disbursement/summary', query_string={
+                'start': '2020-02-01', 'end': '2020-04-01', 'merchant_name': 'merchant_1', 'period': 'quarter'})
+            years = client.get('/disbursement/summary', query_string={
+                'start': '2020-01-01', 'end': '2020-12-31', 'period': 'year'})
+
+        self.assertListEqual(months.json, [
+            {'merchant': 'merchant_1', 'period': '2020-01', 'amount': 101.96, 'fees': 0.96, 'disbursements': 2},
+            {'merchant': 'merchant_1', 'period': '2020-02', 'amount': 0.0, 'fees': 0.0, 'disbursements': 1}])
+        self.assertListEqual(quarters.json, [
+            {'merchant': 'merchant_1', 'period': '2020-Q1', 'amount': 101.96, 'fees': 0.96, 'disbursements': 3},
+            {'merchant': 'merchant_1', 'period': '2020-Q2', 'amount': 10.1, 'fees': 0.1, 'disbursements': 1}])
+        self.assertListEqual(years.json, [
+            {'merchant': 'merchant_1', 'period': '2020', 'amount': 112.06, 'fees': 1.06, 'disbursements': 4},
+            {'merchant': 'merchant_2', 'period': '2020', 'amount': 50.48, 'fees': 0.48, 'disbursements': 4}])
+
+    def test_get_summary_invalid_range(self):
+        with flask_app.app.test_client() as client:
+            response = client.get('/disbursement/summary', query_string={'start': '2020-02-01', 'end': '2020-01-01'})
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_summary_unknown_merchant(self):
+        with flask_app.app.test_client() as client:
+            response = client.get('/disbursement/summary', query_string={
+                'start': '2020-01-01', 'end': '2020-12-31', 'merchant_name': 'unknown'})
+
+        self.assertListEqual(response.json, [])
@@ -0,0 +1,90 @@
+from datetime import date, datetime
+from decimal import Decimal
+from unittest import TestCase
+
+from sequra import app as flask_app
+from sequra.database import db
+from sequra.database.models import Disbursement, Merchant, Order, ScheduledShard, Shopper
+from sequra.scheduler import next_run, previous_week, run_forever, run_week, shards
+
+
+class StopScheduler(Exception):
+    pass
+
+
+class TestScheduler(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        flask_app.configure_app(flask_app=flask_app.app)
+        db.init_app(flask_app.app)
+
+    def setUp(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+            db.create_all()
+            for merchant_id in (1, 2, 5):
+                db.session.add(Merchant(id=merchant_id, cif='11111111H', email=f'merchant_{merchant_id}@test.org',
+                                        name=f'merchant_{merchant_id}'))
+            db.session.add(Shopper(id=1, email='shopper_1@test.org', name='shopper 1', nif='9999999G'))
+            for merchant_id, amount in ((1, '1.00'), (5, '50.00')):
+                db.session.add(Order(merchant_id=merchant_id, shopper_id=1, amount=Decimal(amount),
+                                     created_at=date(2020, 1, 1), completed_at=date(2020, 1, 1)))
+            db.session.commit()
+
+    def tearDown(self):
+        with flask_app.app.app_context():
+            db.drop_all()
+
+    def test_previous_week(self):
+        self.assertEqual(previous_week(date(2020, 1, 6)), (2020, 1))
+        self.assertEqual(previous_week(date(2020, 1, 1)), (2019, 52))
+
+    def test_next_run(self):
+        self.assertEqual(next_run(datetime(2020, 1, 6, 0, 30)), datetime(2020, 1, 6, 1))
+        self.assertEqual(next_run(datetime(2020, 1, 6, 1)), datetime(2020, 1, 13, 1))
+        self.assertEqual(next_run(datetime(2020, 1, 8, 12)), datetime(2020, 1, 13, 1))
+
+    def test_shards(self):
+        with flask_app.app.app_context():
+            self.assertListEqual(shards(shard_size=2), [(0, 1, 1), (2, 3, 1), (4, 5, 1)])
+            self.assertListEqual(shards(shard_size=4), [(0, 3, 2), (4, 7, 1)])
+
+    def test_run_week(self):
+        with flask_app.app.app_context():
+            db.session.add(ScheduledShard(year=2020, week=1, first_merchant_id=0, last_merchant_id=3, merchants=2,
+                                          seconds=0))
+            db.session.commit()
+
+            report = run_week(2020, 1, processes=1, shard_size=4)
+            disbursements = {dis.merchant_id: dis.amount for dis in Disbursement.query}
+
+        self.assertListEqual([(shard['first_merchant_id'], shard['merchants']) for shard in report['shards']], [(4, 1)])
+        self.assertDictEqual(disbursements, {5: Decimal('50.48')})
+
+    def test_run_week_after_merchant_added(self):
+        with flask_app.app.app_context():
+            run_week(2020, 1, processes=1, shard_size=4)
+            db.session.add(Merchant(id=3, cif='33333333J', email='merchant_3@test.org', name='merchant_3'))
+            db.session.add(Order(merchant_id=3, shopper_id=1, amount=Decimal('10.00'), created_at=date(2020, 1, 1),
+                                 completed_at=date(2020, 1, 1)))
+            db.session.commit()
+
+            report = run_week(2020, 1, processes=1, shard_size=4)
+            disbursements = {dis.merchant_id: dis.amount for dis in Disbursement.query}
+            checkpoints = {shard.first_merchant_id: shard.merchants for shard in ScheduledShard.query}
+
+        self.assertListEqual([(shard['first_merchant_id'], shard['merchants']) for shard in report['shards']], [(0, 3)])
+        self.assertEqual(disbursements[3], Decimal('10.10'))
+        self.assertDictEqual(checkpoints, {0: 3, 4: 1})
+
+    def test_run_forever(self):
+        def stop(seconds):
+            self.assertEqual(seconds, (4 * 24 + 13.5) * 3600)
+            raise StopScheduler()
+
+        with flask_app.app.app_context():
+            with self.assertRaises(StopScheduler):
+                run_forever(processes=1, now=lambda: datetime(2020, 1, 8, 11, 30), sleep=stop)
+
+            self.assertEqual(Disbursement.query.filter_by(year=2020, week=1).count(), 3)
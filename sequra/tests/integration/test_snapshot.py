@@ -0,0 +1,83 @@
+import tempfile
+from datetime import date, datetime
+from decimal import Decimal
+from pathlib import Path
+from unittest import TestCase
+
+import numpy as np
+
+from sequra import app as flask_app
+from sequra.database import db
+from sequra.database.models import Merchant, Order, Shopper
+from sequra.snapshot import calculate, export, read_partition
+
+
+class TestSnapshot(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        flask_app.configure_app(flask_app=flask_app.app)
+        db.init_app(flask_app.app)
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.output = Path(self.directory.name)
+        with flask_app.app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add(Merchant(id=1, cif='11111111H', email='merchant_1@test.org', name='merchant_1'))
+            db.session.add(Merchant(id=2, cif='222222222I', email='merchant_2@test.org', name='merchant_2'))
+            db.session.add(Shopper(id=1, email='shopper_1@test.org', name='shopper 1', nif='9999999G'))
+            for merchant_id, amount, completed_at in ((2, '50.00', datetime(2020, 1, 5, 10)),
+                                                      (1, '1.00', datetime(2019, 12, 30, 9)),
+                                                      (1, '300.00', datetime(2020, 1, 13, 8)),
+                                                      (1, '2.00', None)):
+                db.session.add(Order(merchant_id=merchant_id, shopper_id=1, amount=Decimal(amount),
+                                     created_at=date(2019, 12, 1), completed_at=completed_at))
+            db.session.commit()
+
+    def tearDown(self):
+        self.directory.cleanup()
+        with flask_app.app.app_context():
+            db.drop_all()
+
+    def test_export(self):
+        with flask_app.app.app_context():
+            written = export(self.output)
+        columns = read_partition(self.output / '2020-W01')
+
+        self.assertEqual(written, 2)
+        self.assertListEqual(sorted(path.name for path in self.output.iterdir()), ['2020-W01', '2020-W03'])
+        self.assertIsInstance(columns['merchant_id'], np.memmap)
+        self.assertListEqual(columns['merchant_id'].tolist(), [1, 2])
+        self.assertListEqual(columns['amount_cents'].tolist(), [100, 5000])
+        self.assertEqual(columns['completed_at'][0], np.datetime64('2019-12-30T09:00:00'))
+
+    def test_calculate(self):
+        with flask_app.app.app_context():
+            export(self.output, start=date(2020, 1, 1))
+
+        self.assertListEqual(list(calculate(self.output)), [(2020, 1, 1, 101), (2020, 1, 2, 5048),
+                                                            (2020, 3, 1, 30255)])
+        self.assertListEqual(list(calculate(self.output, start=date(2020, 1, 6))), [(2020, 3, 1, 30255)])
+
+    def test_export_reverted_week(self):
+        with flask_app.app.app_context():
+            export(self.output)
+            for order in Order.query.filter_by(completed_week=1):
+                order.completed_at = None
+            db.session.commit()
+            written = export(self.output, start=date(2020, 1, 1), end=date(2020, 1, 5))
+
+        self.assertEqual(written, 0)
+        self.assertListEqual(sorted(path.name for path in self.output.iterdir()), ['2020-W03'])
+        self.assertListEqual(list(calculate(self.output)), [(2020, 3, 1, 30255)])
+
+    def test_export_whole_weeks(self):
+        with flask_app.app.app_context():
+            export(self.output)
+            written = export(self.output, start=date(2020, 1, 5), end=date(2020, 1, 5))
+
+        self.assertEqual(written, 1)
+        self.assertListEqual(sorted(path.name for path in self.output.iterdir()), ['2020-W01', '2020-W03'])
+        self.assertListEqual(read_partition(self.output / '2020-W01')['merchant_id'].tolist(), [1, 2])
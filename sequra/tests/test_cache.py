@@ -0,0 +1,51 @@
+from unittest import TestCase
+
+from sequra.cache import ResponseCache
+
+
+class TestResponseCache(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = ResponseCache(maxsize=2, ttl=10, clock=lambda: self.now)
+
+    def test_get_hit_and_miss(self):
+        self.cache.set('a', 1)
+
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertDictEqual(self.cache.stats(), {'size': 1, 'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+    def test_least_recently_used_evicted(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def test_expired(self):
+        self.cache.set('a', 1)
+        self.now = 10
+
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_emptied_when_version_changes(self):
+        version = 1
+        cache = ResponseCache(maxsize=2, ttl=10, version=lambda: version, check_interval=5, clock=lambda: self.now)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        version = 2
+        self.now = 4
+
+        self.assertEqual(cache.get('a'), 1)
+        self.now = 5
+        self.assertIsNone(cache.get('a'))
+
+    def test_invalidate(self):
+        self.cache.set('a', 1)
+        self.cache.invalidate('a', 'b')
+
+        self.assertIsNone(self.cache.get('a'))
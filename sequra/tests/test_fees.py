@@ -0,0 +1,32 @@
+import decimal
+from unittest import TestCase
+
+from sequra import fees
+
+
+class TestFees(TestCase):
+
+    def test_to_cents(self):
+        self.assertEqual(fees.to_cents('445.5'), 44550)
+        self.assertEqual(fees.to_cents(decimal.Decimal('0.005')), 1)
+
+    def test_from_cents(self):
+        self.assertEqual(str(fees.from_cents(44550)), '445.50')
+        self.assertEqual(str(fees.from_cents(0)), '0.00')
+
+    def test_disbursed_cents_tiers(self):
+        self.assertEqual(fees.disbursed_cents([4999]), 5049)  # 50.4899
+        self.assertEqual(fees.disbursed_cents([5000]), 5048)  # 50.475
+        self.assertEqual(fees.disbursed_cents([29999]), 30284)  # 302.839905
+        self.assertEqual(fees.disbursed_cents([30000]), 30255)  # 302.55
+
+    def test_disbursed_cents_reversal_rounds_half_away_from_zero(self):
+        self.assertEqual(fees.disbursed_cents([-5000]), -5048)
+
+    def test_disbursed_cents_empty(self):
+        self.assertEqual(fees.disbursed_cents([]), 0)
+
+    def test_disbursed_cents_by_merchant(self):
+        disbursed = fees.disbursed_cents_by_merchant([1, 1, 3], [100, 5000, 30000])
+
+        self.assertDictEqual(disbursed, {1: 5149, 3: 30255})
@@ -1,8 +1,12 @@
+import datetime
 import decimal
 from unittest import TestCase
 from unittest.mock import patch
 
-from sequra.database.models import Disbursement
+from sqlalchemy.dialects import postgresql, sqlite
+
+from sequra.database import Upsert
+from sequra.database.models import Disbursement, DisbursementAccumulator, Order, rollup_lock
 
 
 class Test(TestCase):
@@ -10,7 +14,7 @@ class Test(TestCase):
     @patch('sequra.database.models.Order.amounts_by_merchant_in_week')
     def test_calculate_amount_1(self, mock_amounts_by_merchant_in_week):
         merchant_id, week, year = 1, 1, 2020
-        mock_amounts_by_merchant_in_week.return_value = [decimal.Decimal('1')]
+        mock_amounts_by_merchant_in_week.return_value = [100]
 
         disbursed_amount = Disbursement.calculate_amount(merchant_id=merchant_id, week=week, year=year)
 
@@ -19,7 +23,7 @@ class Test(TestCase):
     @patch('sequra.database.models.Order.amounts_by_merchant_in_week')
     def test_calculate_amount_0_99(self, mock_amounts_by_merchant_in_week):
         merchant_id, week, year = 1, 1, 2020
-        mock_amounts_by_merchant_in_week.return_value = [decimal.Decimal('0.99')]
+        mock_amounts_by_merchant_in_week.return_value = [99]
 
         disbursed_amount = Disbursement.calculate_amount(merchant_id=merchant_id, week=week, year=year)
 
@@ -28,7 +32,7 @@ class Test(TestCase):
     @patch('sequra.database.models.Order.amounts_by_merchant_in_week')
     def test_calculate_amount_0_01(self, mock_amounts_by_merchant_in_week):
         merchant_id, week, year = 1, 1, 2020
-        mock_amounts_by_merchant_in_week.return_value = [decimal.Decimal('0.01')]
+        mock_amounts_by_merchant_in_week.return_value = [1]
 
         disbursed_amount = Disbursement.calculate_amount(merchant_id=merchant_id, week=week, year=year)
 
@@ -37,16 +41,16 @@ class Test(TestCase):
     @patch('sequra.database.models.Order.amounts_by_merchant_in_week')
     def test_calculate_amount_50_00(self, mock_amounts_by_merchant_in_week):
         merchant_id, week, year = 1, 1, 2020
-        mock_amounts_by_merchant_in_week.return_value = [decimal.Decimal('50.00')]
+        mock_amounts_by_merchant_in_week.return_value = [5000]
 
         disbursed_amount = Disbursement.calculate_amount(merchant_id=merchant_id, week=week, year=year)
 
-        self.assertEqual(disbursed_amount, decimal.Decimal('50.00') + decimal.Decimal('0.47'))  # 0.47499999
+        self.assertEqual(disbursed_amount, decimal.Decimal('50.00') + decimal.Decimal('0.48'))  # 0.475
 
     @patch('sequra.database.models.Order.amounts_by_merchant_in_week')
     def test_calculate_amount_50_01(self, mock_amounts_by_merchant_in_week):
         merchant_id, week, year = 1, 1, 2020
-        mock_amounts_by_merchant_in_week.return_value = [decimal.Decimal('50.01')]
+        mock_amounts_by_merchant_in_week.return_value = [5001]
 
         disbursed_amount = Disbursement.calculate_amount(merchant_id=merchant_id, week=week, year=year)
 
@@ -55,7 +59,7 @@ class Test(TestCase):
     @patch('sequra.database.models.Order.amounts_by_merchant_in_week')
     def test_calculate_amount_1000(self, mock_amounts_by_merchant_in_week):
         merchant_id, week, year = 1, 1, 2020
-        mock_amounts_by_merchant_in_week.return_value = [decimal.Decimal('1000')]
+        mock_amounts_by_merchant_in_week.return_value = [100000]
 
         disbursed_amount = Disbursement.calculate_amount(merchant_id=merchant_id, week=week, year=year)
 
@@ -64,7 +68,7 @@ class Test(TestCase):
     @patch('sequra.database.models.Order.amounts_by_merchant_in_week')
     def test_calculate_amount_0_01__0_01(self, mock_amounts_by_merchant_in_week):
         merchant_id, week, year = 1, 1, 2020
-        mock_amounts_by_merchant_in_week.return_value = [decimal.Decimal('0.01'), decimal.Decimal('0.01')]
+        mock_amounts_by_merchant_in_week.return_value = [1, 1]
 
         disbursed_amount = Disbursement.calculate_amount(merchant_id=merchant_id, week=week, year=year)
 
@@ -73,8 +77,36 @@ class Test(TestCase):
     @patch('sequra.database.models.Order.amounts_by_merchant_in_week')
     def test_calculate_amount_50_00_50_00(self, mock_amounts_by_merchant_in_week):
         merchant_id, week, year = 1, 1, 2020
-        mock_amounts_by_merchant_in_week.return_value = [decimal.Decimal('50.00') + decimal.Decimal('50.00')]
+        mock_amounts_by_merchant_in_week.return_value = [5000 + 5000]
 
         disbursed_amount = Disbursement.calculate_amount(merchant_id=merchant_id, week=week, year=year)
 
-        self.assertEqual(disbursed_amount, decimal.Decimal('100.00') + decimal.Decimal('0.95'))  # 0.94999998
+        self.assertEqual(disbursed_amount, decimal.Decimal('100.00') + decimal.Decimal('0.95'))  # 0.95
+
+    def test_order_completed_iso_week(self):
+        order = Order(completed_at=datetime.datetime(2021, 1, 1, 12, 0, 0))
+
+        self.assertEqual((order.completed_year, order.completed_week), (2020, 53))
+
+    def test_order_not_completed_iso_week(self):
+        order = Order(completed_at=None)
+
+        self.assertEqual((order.completed_year, order.completed_week), (None, None))
+
+    def test_rollup_lock_in_merchant_order(self):
+        statement = str(rollup_lock([2, 1]).compile(dialect=postgresql.dialect(),
+                                                       compile_kwargs={'literal_binds': True}))
+
+        self.assertEqual(' '.join(statement.split()),
+                         'SELECT pg_advisory_xact_lock(724102, ids.id) AS pg_advisory_xact_lock_1 FROM '
+                         '(SELECT merchant.id AS id FROM merchant WHERE merchant.id IN (2, 1) ORDER BY merchant.id) '
+                         'AS ids')
+
+    def test_upsert_increments_the_current_row(self):
+        upsert = Upsert(DisbursementAccumulator.__table__, index_elements=('merchant_id', 'year', 'week'),
+                        increment_columns=('orders',))
+
+        for dialect in (sqlite.dialect(), postgresql.dialect()):
+            self.assertTrue(str(upsert.compile(dialect=dialect)).endswith(
+                'ON CONFLICT (merchant_id, year, week) DO UPDATE SET orders = disbursement_accumulator.orders + '
+                'excluded.orders'))
@@ -0,0 +1,32 @@
+import datetime
+import json
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from sequra.database import _parse_datetime, _records_from_json
+
+RESOURCES_DIR = Path(__file__).parent.parent / 'resources'
+
+
+class TestSeed(TestCase):
+
+    def test_records_from_json_streams_every_record(self):
+        orders_file = RESOURCES_DIR / 'orders.json'
+        with orders_file.open() as file_d:
+            expected = json.load(file_d)['RECORDS']
+
+        self.assertListEqual(list(_records_from_json(orders_file, read_size=100)), expected)
+
+    def test_records_from_json_empty(self):
+        with tempfile.TemporaryDirectory() as directory:
+            empty_file = Path(directory) / 'empty.json'
+            empty_file.write_text('{"RECORDS": [ ]}')
+
+            self.assertListEqual(list(_records_from_json(empty_file)), [])
+
+    def test_parse_datetime(self):
+        self.assertEqual(_parse_datetime('07/01/2018 14:24:01'), datetime.datetime(2018, 1, 7, 14, 24, 1))
+
+    def test_parse_datetime_empty(self):
+        self.assertIsNone(_parse_datetime(''))
@@ -0,0 +1,14 @@
+"""
+    WSGI entry point
+    ================
+
+    Production serving mode, instead of the single threaded development server of app.run():
+
+    gunicorn -c sequra/resources/gunicorn.conf.py sequra.wsgi:application
+
+    Workers and threads are set by SEQURA_WEB_WORKERS and SEQURA_WEB_THREADS. Several workers require a persistent
+    database, SEQURA_DATABASE_URI, since each worker would otherwise load its own in-memory copy.
+"""
+from sequra.app import create_app
+
+application = create_app()
@@ -17,8 +17,8 @@ setup(
         'Programming Language :: Python :: 3.8',
     ],
 
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
 
     install_requires=install_reqs,
-    extras_require={'test': ['pytest', 'coverage']},
+    extras_require={'test': ['pytest', 'coverage'], 'postgresql': ['psycopg2-binary'], 'serve': ['gunicorn']},
 )